@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import argparse
+import logging
+import os
+import sys
+
+logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "src")))
+
+from calchas import trip
+from calchas.common import recfile
+
+
+# Sensors whose CSV output has a binary counterpart.
+CONVERTIBLE_SENSORS = ["systeminfo", "imu", "gps"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert the CSV sensor files of recorded trips into the binary record format.")
+
+    parser.add_argument("trip_dirs", nargs="+", help="The trip directories to convert.")
+    parser.add_argument("--remove", action="store_true", help="Remove the CSV files after successful conversion.")
+
+    return parser.parse_args()
+
+
+def convert_trip(trip_dir: str, remove: bool) -> None:
+    with trip.TripManager.read(trip_dir) as t:
+        defaults = t.default_options()["sensors"]
+        converted = False
+        for name in CONVERTIBLE_SENSORS:
+            options = t.options.get("sensors", {}).get(name, {})
+            csv_path = os.path.join(t.directory, options.get("output", defaults[name]["output"]))
+            bin_path = os.path.join(t.directory, options.get("output_binary", defaults[name]["output_binary"]))
+            if not os.path.isfile(csv_path):
+                continue
+
+            count = recfile.convert_csv(csv_path, bin_path)
+            logging.info(f"Converted {csv_path} to {bin_path} ({count} records)")
+            if remove:
+                os.remove(csv_path)
+
+            # The trip options describe the files on disk.
+            sensor_options = t.options.setdefault("sensors", {}).setdefault(name, {})
+            sensor_options["output_format"] = "binary"
+            sensor_options["output_binary"] = os.path.basename(bin_path)
+            converted = True
+
+        if converted:
+            t.save_options()
+
+
+def main() -> int:
+    args = parse_args()
+
+    rc = 0
+    for trip_dir in args.trip_dirs:
+        try:
+            convert_trip(trip_dir, args.remove)
+        except Exception:
+            logging.exception(f"Failed to convert {trip_dir}")
+            rc = 1
+    return rc
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -79,6 +79,7 @@ def parse_args():
     parser.add_argument("--webcam", action="store_true", help="Ignore the recorder startup pin and start webcam sensor.")
     parser.add_argument("--imu", action="store_true", help="Ignore the recorder startup pin and start imu sensor.")
     parser.add_argument("--gps", action="store_true", help="Ignore the recorder startup pin and start gps sensor.")
+    parser.add_argument("--telemetry", action="store_true", help="Record message bus telemetry (also used by healthmon).")
 
     return parser.parse_args()
 
@@ -105,6 +106,9 @@ def main() -> int:
             },
         },
         "sensors": {
+            "telemetry": {
+                "active": args.telemetry,
+            },
             "systeminfo": {
                 "active": args.systeminfo or StartupFlags.SENSOR_SYSINFO.is_active(),
             },
@@ -32,6 +32,7 @@ import streamlit as st
 # sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "src")))
 
 from calchas import trip
+from calchas.common import recfile
 
 
 def to_datetime(timestamp):
@@ -40,15 +41,31 @@ def to_datetime(timestamp):
     return datetime.datetime.fromtimestamp(float(timestamp))
 
 
+def read_sensor_table(trip_path: str, name: str):
+    """Load <name>.bin or <name>.csv indexed by timestamp, or None if the trip has neither."""
+    bin_path = os.path.join(trip_path, f"{name}.bin")
+    if os.path.isfile(bin_path):
+        records = recfile.read(bin_path)
+        if not records.dtype.names:
+            return None  # Nothing was recorded
+        df = pd.DataFrame(records)
+        df["timestamp"] = df["timestamp"].map(to_datetime)
+        return df.set_index("timestamp")
+
+    csv_path = os.path.join(trip_path, f"{name}.csv")
+    if os.path.isfile(csv_path):
+        return pd.read_csv(csv_path, index_col="timestamp", converters={"timestamp": to_datetime})
+    return None
+
+
 def run(trip_path: str):
     with trip.TripManager.read(trip_path) as t:
         st.sidebar.text(t.directory)
         st.sidebar.text(json.dumps(t.options, indent=4))
 
         # SYSTEMINFO
-        csv_path = os.path.join(trip_path, "systeminfo.csv")
-        if os.path.isfile(csv_path):
-            df = pd.read_csv(csv_path, index_col="timestamp", converters={"timestamp": to_datetime})
+        df = read_sensor_table(trip_path, "systeminfo")
+        if df is not None:
 
             system_infos = ["system_cpu_percent", "system_virtual_memory_percent", "disk_percent",]
             system_cpu_times = ["system_cpu_times_percent_system", "system_cpu_times_percent_user", "system_cpu_times_percent_idle",]
@@ -80,9 +97,8 @@ def run(trip_path: str):
                 st.line_chart(df[x])
 
         # IMU
-        csv_path = os.path.join(trip_path, "imu.csv")
-        if os.path.isfile(csv_path):
-            df = pd.read_csv(csv_path, index_col="timestamp", converters={"timestamp": to_datetime})
+        df = read_sensor_table(trip_path, "imu")
+        if df is not None:
 
             gyro = ["gyro_x", "gyro_y", "gyro_z",]
             acc = ["acc_x", "acc_y", "acc_z",]
@@ -101,10 +117,9 @@ def run(trip_path: str):
                 st.line_chart(df[x])
 
         # GPS
-        csv_path = os.path.join(trip_path, "gps.csv")
-        if os.path.isfile(csv_path):
-            try:
-                df = pd.read_csv(csv_path, index_col="timestamp", converters={"timestamp": to_datetime})
+        try:
+            df = read_sensor_table(trip_path, "gps")
+            if df is not None:
                 df = df.replace(0, np.nan)
                 df = df.dropna(how='all', axis=0)
 
@@ -131,6 +146,10 @@ def run(trip_path: str):
                         dists.append(dist)
                         speeds.append(speed)
 
+                    if "ground_speed" in df:
+                        # Recorded in UBX mode: use the receiver's ground speed (m/s).
+                        speeds = list(df["ground_speed"].fillna(0) * 3.6)
+
                     df["Distance"] = dists
                     df["km/h"] = speeds
 
@@ -138,8 +157,8 @@ def run(trip_path: str):
                     st.dataframe(df)
                     st.write(f"points={len(df)} distance={sum(dists) / 1000.:.3f}km avg_speed={sum(speeds) / len(speeds):.2f}km/h")
                     st.map(df)
-            except pd.errors.EmptyDataError:
-                logging.warning("Empty GPS file.")
+        except pd.errors.EmptyDataError:
+            logging.warning("Empty GPS file.")
 
         # PICAM
         mp4_path = os.path.join(trip_path, "picam.mp4")
@@ -207,8 +226,9 @@ def import_remote_trips(hostname: str, trip_dirs: List[str], out_dir: str, progr
                 )
 
             # TODO: Improve me!
+            # Recordings made with "output_container": "mp4" are playable as they are.
             picam_h264_path = os.path.join(local_trip_dir, "picam.h264")
-            if os.path.isfile(picam_h264_path):
+            if os.path.isfile(picam_h264_path) and not os.path.isfile(f"{picam_h264_path[:-4]}mp4"):
                 mp4_path = f"{picam_h264_path[:-4]}mp4"
                 ffmpeg_path = r"C:\Users\vobject\Tools\ffmpeg-4.2.1-win64-static\bin\ffmpeg.exe"
                 # ffmpeg_path = r"C:\Users\user\Downloads\Python\ffmpeg-20200417-889ad93-win64-static\bin\ffmpeg.exe"
@@ -0,0 +1,192 @@
+"""AVI (OpenDML) muxing of already compressed MJPEG frames.
+
+Frames are appended to the file in order, so it can be written through a
+DiskWriter. Sizes, frame counts and indexes that are only known at the end are
+patched into the header after the file has been closed. A RIFF is limited to
+"max_riff_bytes"; longer recordings continue in AVIX extension RIFFs that
+OpenDML readers (ffmpeg, VLC, OpenCV, ...) play as one stream.
+"""
+
+import struct
+from typing import BinaryIO, List, Optional, Tuple
+
+AVIF_HASINDEX = 0x10
+AVIF_ISINTERLEAVED = 0x100
+AVIIF_KEYFRAME = 0x10
+AVI_INDEX_OF_INDEXES = 0x00
+AVI_INDEX_OF_CHUNKS = 0x01
+
+SUPER_INDEX_ENTRIES = 256
+_SUPER_INDEX_ENTRY = struct.Struct("<QII")
+
+
+def _chunk_header(fourcc: bytes, size: int) -> bytes:
+    return struct.pack("<4sI", fourcc, size)
+
+
+def jpeg_size(jpeg) -> Optional[Tuple[int, int]]:
+    """(width, height) from the start of frame segment of a JPEG, None if there is none."""
+    data = memoryview(jpeg).cast("B")
+    pos = 2  # SOI
+    while pos + 4 <= len(data) and data[pos] == 0xFF:
+        marker = data[pos + 1]
+        length = (data[pos + 2] << 8) | data[pos + 3]
+        # SOF0-SOF15 except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            if pos + 9 > len(data):
+                return None
+            height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+            return width, height
+        if marker == 0xDA:  # Start of scan without a frame header
+            return None
+        pos += 2 + length
+    return None
+
+
+class AviWriter:
+    """Writes one MJPEG video stream at a constant frame rate; every frame is a keyframe.
+
+    The frame size in the header is taken from the first frame if it differs
+    from the given one, e.g. when a camera does not support the requested size.
+    Frames that were not captured are written as empty chunks (skip_frames()),
+    which players treat as a repetition of the previous frame.
+    """
+    def __init__(self, fd: BinaryIO, path: str, width: int, height: int, framerate: float, max_riff_bytes: int=1 << 30):
+        self.fd = fd
+        self.path = path
+        self.width = width
+        self.height = height
+        self.framerate = framerate
+        self.max_riff_bytes = max_riff_bytes
+
+        self.position = 0
+        self.frames = 0
+        self.max_frame_size = 0
+        self._patches: List[Tuple[int, bytes]] = []
+        self._riffs: List[Tuple[int, int]] = []  # (size field offset, movi size field offset)
+        self._movi_start = 0
+        self._first_riff_frames = None
+        self._idx1: List[Tuple[int, int]] = []  # (offset relative to "movi", size) of the first RIFF's frames
+        self._chunks: List[Tuple[int, int]] = []  # (absolute data offset, size) of the current RIFF's frames
+        self._super_index: List[Tuple[int, int, int]] = []
+
+        self._write_header()
+
+    def write_frame(self, jpeg) -> None:
+        if not self.max_frame_size:
+            self.width, self.height = jpeg_size(jpeg) or (self.width, self.height)
+        self._write_chunk(jpeg)
+
+    def skip_frames(self, count: int) -> None:
+        for _ in range(count):
+            self._write_chunk(b"")
+
+    def _write_chunk(self, data) -> None:
+        size = len(data)
+        if self._chunks and self.position + 8 + size - self._riffs[-1][0] > self.max_riff_bytes:
+            self._end_riff()
+            self._begin_riff(b"AVIX")
+
+        chunk_offset = self.position
+        self._write(_chunk_header(b"00dc", size))
+        if size:
+            self._write(data)
+        if size % 2:
+            self._write(b"\x00")
+
+        self._chunks.append((chunk_offset + 8, size))
+        if self._first_riff_frames is None:
+            self._idx1.append((chunk_offset - self._movi_start, size))
+        self.frames += 1
+        self.max_frame_size = max(self.max_frame_size, size)
+
+    def close(self) -> None:
+        self._end_riff()
+        self.fd.close()
+
+        self._patches += [
+            (self._avih_offset + 4, struct.pack("<I", self.max_frame_size * int(round(self.framerate)))),
+            (self._avih_offset + 16, struct.pack("<I", self._first_riff_frames)),
+            (self._avih_offset + 28, struct.pack("<III", self.max_frame_size, self.width, self.height)),
+            (self._strh_offset + 32, struct.pack("<II", self.frames, self.max_frame_size)),
+            (self._strh_offset + 52, struct.pack("<hh", self.width, self.height)),
+            (self._strf_offset + 4, struct.pack("<ii", self.width, self.height)),
+            (self._strf_offset + 20, struct.pack("<I", self.width * self.height * 3)),
+            (self._dmlh_offset, struct.pack("<I", self.frames)),
+            (self._indx_offset + 4, struct.pack("<I", len(self._super_index))),
+            (self._indx_offset + 24, b"".join(_SUPER_INDEX_ENTRY.pack(*e) for e in self._super_index)),
+        ]
+        with open(self.path, "r+b") as f:
+            for offset, data in self._patches:
+                f.seek(offset)
+                f.write(data)
+
+    def _write(self, data) -> None:
+        self.fd.write(data)
+        self.position += len(data)
+
+    def _write_header(self) -> None:
+        # Scale/rate: the nominal frame rate in 1/1000 frames per second.
+        scale, rate = 1000, int(round(self.framerate * 1000))
+
+        avih = struct.pack("<14I", int(round(1e6 / self.framerate)), 0, 0, AVIF_HASINDEX | AVIF_ISINTERLEAVED, 0, 0, 1, 0,
+            self.width, self.height, 0, 0, 0, 0)
+        strh = struct.pack("<4s4sIHH6IiI4h", b"vids", b"MJPG", 0, 0, 0, 0, scale, rate, 0, 0, 0, -1, 0,
+            0, 0, self.width, self.height)
+        strf = struct.pack("<IiiHH4sIiiII", 40, self.width, self.height, 1, 24, b"MJPG", self.width * self.height * 3, 0, 0, 0, 0)
+        indx = struct.pack("<HBBI4s3I", 4, 0, AVI_INDEX_OF_INDEXES, 0, b"00dc", 0, 0, 0) + bytes(SUPER_INDEX_ENTRIES * _SUPER_INDEX_ENTRY.size)
+        dmlh = bytes(248)
+
+        strl = b"".join([
+            b"strl",
+            _chunk_header(b"strh", len(strh)), strh,
+            _chunk_header(b"strf", len(strf)), strf,
+            _chunk_header(b"indx", len(indx)), indx,
+        ])
+        odml = b"odml" + _chunk_header(b"dmlh", len(dmlh)) + dmlh
+        hdrl = b"".join([
+            b"hdrl",
+            _chunk_header(b"avih", len(avih)), avih,
+            _chunk_header(b"LIST", len(strl)), strl,
+            _chunk_header(b"LIST", len(odml)), odml,
+        ])
+
+        # Offsets of the fields patched on close; the RIFF header is 12 bytes.
+        hdrl_offset = 12 + 8
+        self._avih_offset = hdrl_offset + 4 + 8
+        strl_offset = self._avih_offset + len(avih) + 8
+        self._strh_offset = strl_offset + 4 + 8
+        self._strf_offset = self._strh_offset + len(strh) + 8
+        self._indx_offset = self._strf_offset + len(strf) + 8
+        self._dmlh_offset = strl_offset + len(strl) + 8 + 4 + 8
+
+        self._begin_riff(b"AVI ", _chunk_header(b"LIST", len(hdrl)) + hdrl)
+
+    def _begin_riff(self, form: bytes, header: bytes=b"") -> None:
+        riff_offset = self.position
+        self._write(_chunk_header(b"RIFF", 0) + form + header)
+        movi_offset = self.position
+        self._write(_chunk_header(b"LIST", 0) + b"movi")
+        self._riffs.append((riff_offset, movi_offset))
+        self._movi_start = movi_offset + 8
+        self._chunks = []
+
+    def _end_riff(self) -> None:
+        riff_offset, movi_offset = self._riffs[-1]
+
+        # Standard index of this RIFF's frames at the end of its movi list.
+        if self._chunks and len(self._super_index) < SUPER_INDEX_ENTRIES:
+            base = movi_offset
+            entries = b"".join(struct.pack("<II", offset - base, size) for offset, size in self._chunks)
+            ix = struct.pack("<HBBI4sQI", 2, 0, AVI_INDEX_OF_CHUNKS, len(self._chunks), b"00dc", base, 0) + entries
+            self._super_index.append((self.position, 8 + len(ix), len(self._chunks)))
+            self._write(_chunk_header(b"ix00", len(ix)) + ix)
+        self._patches.append((movi_offset + 4, struct.pack("<I", self.position - movi_offset - 8)))
+
+        if self._first_riff_frames is None:
+            # The legacy index covers the first RIFF only.
+            self._first_riff_frames = len(self._idx1)
+            idx1 = b"".join(struct.pack("<4sIII", b"00dc", AVIIF_KEYFRAME if size else 0, offset, size) for offset, size in self._idx1)
+            self._write(_chunk_header(b"idx1", len(idx1)) + idx1)
+            self._idx1 = []
+        self._patches.append((riff_offset + 4, struct.pack("<I", self.position - riff_offset - 8)))
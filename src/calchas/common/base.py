@@ -1,8 +1,10 @@
+import collections
+import enum
 import logging
 import queue
 import threading
 import time
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Tuple
 
 
 class SensorBase:
@@ -27,20 +29,155 @@ class SensorBase:
 
 
 class Message:
-    def __init__(self, sensor: SensorBase, topic: str, data: Any):
-        self.timestamp = time.time()
-        self.sensor = sensor
-        self.topic = topic
-        self.data = data
+    """A published sample. One instance is shared by all subscribers of a topic, so it is read-only."""
+    __slots__ = ("timestamp", "sensor", "topic", "data")
+
+    def __init__(self, sensor: SensorBase, topic: str, data: Any, timestamp: float=None):
+        object.__setattr__(self, "timestamp", time.time() if timestamp is None else timestamp)
+        object.__setattr__(self, "sensor", sensor)
+        object.__setattr__(self, "topic", topic)
+        object.__setattr__(self, "data", data)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f"Message is immutable, cannot set '{name}'")
+
+    def __delattr__(self, name: str) -> None:
+        raise AttributeError(f"Message is immutable, cannot delete '{name}'")
+
+
+class OverflowPolicy(enum.Enum):
+    """What a full subscriber queue does with a new message."""
+    BLOCK = "block"  # Wait until the consumer made room
+    DROP_OLDEST = "drop_oldest"  # Discard the oldest queued message
+    DROP_NEWEST = "drop_newest"  # Discard the new message
+    LATEST = "latest"  # Only ever keep the newest message
+
+
+class MessageQueue:
+    """Bounded message queue with a configurable overflow policy.
+
+    A maxsize of 0 means unbounded (the LATEST policy always holds a single message).
+    """
+    def __init__(self, maxsize: int=0, policy: OverflowPolicy=OverflowPolicy.BLOCK):
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._closed = False
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def put(self, item: Any) -> bool:
+        with self._lock:
+            if self._closed:
+                return False
+
+            if self.policy is OverflowPolicy.LATEST:
+                self.dropped += len(self._items)
+                self._items.clear()
+            elif self.maxsize > 0 and len(self._items) >= self.maxsize:
+                if self.policy is OverflowPolicy.BLOCK:
+                    while len(self._items) >= self.maxsize and not self._closed:
+                        self._not_full.wait()
+                    if self._closed:
+                        return False
+                elif self.policy is OverflowPolicy.DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                else:
+                    self.dropped += 1
+                    return False
+
+            self._items.append(item)
+            self._not_empty.notify()
+            return True
+
+    def get(self, timeout: float=None) -> Any:
+        with self._lock:
+            if not self._items:
+                self._not_empty.wait(timeout)
+                if not self._items:
+                    raise queue.Empty
+            item = self._items.popleft()
+            self._not_full.notify()
+            return item
+
+    def get_batch(self, max_items: int, timeout: float=None) -> List[Any]:
+        """Wait for at least one message, then take up to max_items at once."""
+        with self._lock:
+            if not self._items:
+                self._not_empty.wait(timeout)
+                if not self._items:
+                    raise queue.Empty
+            count = min(max_items, len(self._items))
+            items = [self._items.popleft() for _ in range(count)]
+            self._not_full.notify(count)
+            return items
+
+    def close(self) -> None:
+        """Reject further messages and release producers blocked in put()."""
+        with self._lock:
+            self._closed = True
+            self._not_full.notify_all()
+            self._not_empty.notify_all()
+
+
+class _SubscriberCounters:
+    """What a subscriber's consumer thread did since the counters were last taken.
+
+    Updated once per batch. Latency is from a message's timestamp until its
+    batch was handed to the subscriber; processing time is per batch callback.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self) -> None:
+        self.messages = 0
+        self.batches = 0
+        self.latency_sum = 0.
+        self.latency_max = 0.
+        self.processing_sum = 0.
+        self.processing_max = 0.
+
+    def add(self, messages: List[Message], started: float, finished: float) -> None:
+        latencies = [started - m.timestamp for m in messages]
+        processing = finished - started
+        with self._lock:
+            self.messages += len(messages)
+            self.batches += 1
+            self.latency_sum += sum(latencies)
+            self.latency_max = max(self.latency_max, max(latencies))
+            self.processing_sum += processing
+            self.processing_max = max(self.processing_max, processing)
+
+    def take(self) -> Dict[str, Any]:
+        with self._lock:
+            values = {
+                "processed": self.messages,
+                "latency_avg_ms": 1000. * self.latency_sum / self.messages if self.messages else 0.,
+                "latency_max_ms": 1000. * self.latency_max,
+                "processing_avg_ms": 1000. * self.processing_sum / self.batches if self.batches else 0.,
+                "processing_max_ms": 1000. * self.processing_max,
+            }
+            self._reset()
+        return values
 
 
 class Subscriber:
     def __init__(self, options: Any):
         super().__init__()
         self._options = options or {}
+        self.writer = None  # Optional shared diskwriter.DiskWriter, set by the recorder
+        self.runtime = None  # Optional shared runtime.AsyncRuntime, set by the recorder
         self._messages = None
         self._message_thread = None
         self._run_message_thread = False
+        self._counters = _SubscriberCounters()
 
     @property
     def options(self) -> Any:
@@ -58,9 +195,39 @@ class Subscriber:
     def out_dir(self) -> str:
         return self.options["out_dir"]
 
+    @property
+    def dropped_messages(self) -> int:
+        return self._messages.dropped if self._messages is not None else 0
+
+    def telemetry(self) -> Dict[str, Any]:
+        """Queue state and the message counters since the previous call."""
+        values = self._counters.take()
+        values.update({
+            "queue_depth": len(self._messages) if self._messages is not None else 0,
+            "queue_size": self._messages.maxsize if self._messages is not None else 0,
+            "dropped": self.dropped_messages,
+        })
+        return values
+
+    def adjust(self, changes: Dict[str, Any]) -> bool:
+        """Apply option changes while running (e.g. a lower quality); False if none of them is supported.
+
+        The options themselves stay untouched; they describe the configured state.
+        """
+        return False
+
+    def topics(self, publisher: "Publisher") -> List[str]:
+        """The topics of publisher this subscriber wants; all offered topics by default."""
+        return publisher.offer()
+
     def on_process_message(self, msg: Message) -> None:
         raise NotImplementedError
 
+    def on_process_batch(self, messages: List[Message]) -> None:
+        # Subscribers that can handle several messages at once override this.
+        for msg in messages:
+            self.on_process_message(msg)
+
     def on_message(self, msg: Message) -> None:
         if self._run_message_thread:
             self._messages.put(msg)
@@ -69,9 +236,12 @@ class Subscriber:
         try:
             self._start_impl()
 
+            self._messages = MessageQueue(
+                self.options.get("queue_size", 0),
+                OverflowPolicy(self.options.get("queue_policy", OverflowPolicy.BLOCK.value)),
+            )
             self._run_message_thread = True
-            self._messages = queue.Queue()
-            self._message_thread = threading.Thread(target=self._consume_message_thread_fn)
+            self._message_thread = threading.Thread(target=self._consume_message_thread_fn, name=f"{self.name}-consumer")
             self._message_thread.start()
             return True
         except NotImplementedError:
@@ -83,10 +253,12 @@ class Subscriber:
     def stop(self) -> None:
         try:
             self._run_message_thread = False
+            if self._messages is not None:
+                # Keep the closed queue around so its drop count can still be read.
+                self._messages.close()
             if self._message_thread:
                 self._message_thread.join()
                 self._message_thread = None
-            self._messages = queue.Queue()
 
             self._stop_impl()
         except NotImplementedError:
@@ -101,20 +273,29 @@ class Subscriber:
         raise NotImplementedError
 
     def _consume_message_thread_fn(self) -> None:
+        batch_size = self.options.get("queue_batch_size", 100)
         while self._run_message_thread:
             try:
-                msg = self._messages.get(True, 1.)
+                messages = self._messages.get_batch(batch_size, 1.)
             except queue.Empty:
                 continue
 
-            self.on_process_message(msg)
+            started = time.time()
+            self.on_process_batch(messages)
+            self._counters.add(messages, started, time.time())
 
 
 class Publisher(SensorBase):
     def __init__(self, options: Any):
         super().__init__(options)
-        self._subscribers: Dict[str, List[Subscriber]] = {}
+        # Dispatch table: topic -> subscribers. Both the table and the tuples are
+        # replaced on every change (copy-on-write), so publish() can read them
+        # without taking the lock. The lock only serializes writers.
+        self._subscribers: Dict[str, Tuple[Subscriber, ...]] = {}
         self._subscribers_lock = threading.RLock()
+        self.writer = None  # Optional shared diskwriter.DiskWriter, set by the recorder
+        self.runtime = None  # Optional shared runtime.AsyncRuntime, set by the recorder
+        self._published: Dict[str, int] = {}  # topic -> messages published
 
     def offer(self) -> List[str]:
         # Offered sensors may not change during lifetime of object.
@@ -123,10 +304,11 @@ class Publisher(SensorBase):
     def subscribe(self, subscriber: Subscriber, topic: str=None) -> None:
         with self._subscribers_lock:
             if topic:
-                subs = self._subscribers.get(topic, [])
+                subs = self._subscribers.get(topic, ())
                 if not subscriber in subs:
-                    subs.append(subscriber)
-                    self._subscribers[topic] = subs
+                    table = dict(self._subscribers)
+                    table[topic] = subs + (subscriber,)
+                    self._subscribers = table
             else:
                 # Subscribe to all topics
                 for t in self.offer():
@@ -135,20 +317,37 @@ class Publisher(SensorBase):
     def unsubscribe(self, subscriber: Subscriber, topic: str=None) -> None:
         with self._subscribers_lock:
             if topic:
-                for t, subs in self._subscribers.items():
-                    if t == topic and subscriber in subs:
-                        subs.remove(subscriber)
+                subs = self._subscribers.get(topic, ())
+                if subscriber in subs:
+                    table = dict(self._subscribers)
+                    table[topic] = tuple(s for s in subs if s is not subscriber)
+                    self._subscribers = table
             else:
                 # Unsubscribe from all topics
                 for t in self.offer():
                     self.unsubscribe(subscriber, t)
 
-    def publish(self, topic: str, payload: Any) -> None:
-        with self._subscribers_lock:
-            for t, subs in self._subscribers.items():
-                if t == topic:
-                    for s in subs:
-                        s.on_message(Message(self, topic, payload))
+    def has_subscribers(self, topic: str) -> bool:
+        # Lets sensors skip producing payloads nobody consumes.
+        return bool(self._subscribers.get(topic))
+
+    def publish(self, topic: str, payload: Any, timestamp: float=None) -> None:
+        subs = self._subscribers.get(topic)
+        if not subs:
+            return
+
+        self._published[topic] = self._published.get(topic, 0) + 1
+        msg = Message(self, topic, payload, timestamp)
+        for s in subs:
+            s.on_message(msg)
+
+    def adjust(self, changes: Dict[str, Any]) -> bool:
+        """See Subscriber.adjust()."""
+        return False
+
+    def telemetry(self) -> Dict[str, Any]:
+        """Messages published per topic so far (only counting topics with subscribers)."""
+        return {"published": dict(self._published)}
 
     def start(self) -> bool:
         try:
@@ -0,0 +1,225 @@
+import collections
+import logging
+import os
+import threading
+import time
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+
+class DiskFile:
+    """Write-only binary file whose writes are carried out by a DiskWriter."""
+    def __init__(self, writer: "DiskWriter", path: str):
+        self.writer = writer
+        self.path = path
+        self.fd = open(path, "wb", buffering=0)
+        self.closed = False
+        self.bytes_written = 0
+        self.unsynced_bytes = 0
+        self.last_sync = time.time()
+        self._close_event = threading.Event()
+
+    def write(self, data: bytes) -> int:
+        # The buffer is written later; callers must not modify it afterwards.
+        if self.closed:
+            raise ValueError(f"write to closed file {self.path}")
+        self.writer.submit(self, data)
+        return len(data)
+
+    def flush(self) -> None:
+        # Data is handed to the writer on every write(); durability follows its fsync policy.
+        pass
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.submit(self, None)
+        self._close_event.wait()
+
+
+class DiskWriter:
+    """Shared background writer.
+
+    Outputs hand over ready-made buffers. A single thread merges everything queued
+    for a file into one sequential write and applies the fsync policy: a file is
+    synced once "fsync_interval_ms" passed or "fsync_bytes" were written since its
+    last sync (0 disables a criterion). Producers block once "max_pending_bytes"
+    are queued so a stalled SD card cannot exhaust memory.
+    """
+    def __init__(self, options: Dict[str, Any]):
+        self.options = options or {}
+        self.fsync_interval_sec = self.options.get("fsync_interval_ms", 1000) / 1000.
+        self.fsync_bytes = self.options.get("fsync_bytes", 0)
+        self.max_pending_bytes = self.options.get("max_pending_bytes", 32 * 1024 * 1024)
+
+        self.bytes_written = 0
+        self.write_calls = 0
+        self.fsync_calls = 0
+
+        self._pending: Deque[Tuple[DiskFile, Optional[bytes], float]] = collections.deque()
+        self._pending_bytes = 0
+        self._files: List[DiskFile] = []
+        self._latencies: Deque[float] = collections.deque(maxlen=self.options.get("latency_samples", 10000))
+        self._lock = threading.Lock()
+        self._has_data = threading.Condition(self._lock)
+        self._has_room = threading.Condition(self._lock)
+        self._sync_lock = threading.Lock()  # Serializes synchronous writes without a writer thread
+        self._thread = None
+        self._running = False
+
+    def open(self, path: str) -> DiskFile:
+        f = DiskFile(self, path)
+        with self._lock:
+            self._files.append(f)
+        return f
+
+    def submit(self, f: DiskFile, data: Optional[bytes]) -> None:
+        with self._lock:
+            size = len(data) if data is not None else 0
+            while self._running and self._pending_bytes > 0 and self._pending_bytes + size > self.max_pending_bytes:
+                self._has_room.wait()
+
+            if self._running:
+                self._pending.append((f, data, time.time()))
+                self._pending_bytes += size
+                self._has_data.notify()
+                return
+            thread = self._thread
+
+        # Not started (or stopped): write synchronously, after the writer thread's last batch.
+        if thread:
+            thread.join()
+        with self._sync_lock:
+            if data is not None:
+                self._write(f, [data], [])
+            else:
+                self._close(f)
+
+    def start(self) -> None:
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._write_thread_fn, name="diskwriter")
+        self._thread.start()
+
+    def stop(self) -> None:
+        with self._lock:
+            self._running = False
+            self._has_data.notify_all()
+            self._has_room.notify_all()
+            thread = self._thread
+        if thread:
+            thread.join()
+        with self._lock:
+            if not self._running:
+                self._thread = None
+
+    def stats(self) -> Dict[str, Any]:
+        latencies = sorted(self._latencies)
+
+        def percentile(p: float) -> float:
+            if not latencies:
+                return 0.
+            return latencies[min(len(latencies) - 1, int(round(p / 100. * (len(latencies) - 1))))]
+
+        return {
+            "bytes_written": self.bytes_written,
+            "write_calls": self.write_calls,
+            "fsync_calls": self.fsync_calls,
+            "latency_ms_p50": percentile(50) * 1000.,
+            "latency_ms_p95": percentile(95) * 1000.,
+            "latency_ms_p99": percentile(99) * 1000.,
+            "latency_ms_max": (latencies[-1] if latencies else 0.) * 1000.,
+        }
+
+    def file_stats(self) -> Dict[str, int]:
+        """Bytes written so far to each open file, by path."""
+        with self._lock:
+            return {f.path: f.bytes_written for f in self._files}
+
+    def _write_thread_fn(self) -> None:
+        while True:
+            with self._lock:
+                if not self._pending and self._running:
+                    self._has_data.wait(self.fsync_interval_sec if self.fsync_interval_sec > 0 else None)
+                batch = self._pending
+                self._pending = collections.deque()
+                self._pending_bytes = 0
+                self._has_room.notify_all()
+                running = self._running
+
+            self._commit(batch)
+            if not running and not self._pending:
+                break
+
+    def _commit(self, batch: Deque[Tuple[DiskFile, Optional[bytes], float]]) -> None:
+        # Group the queued buffers per file, keeping their order.
+        chunks: Dict[DiskFile, Tuple[List[bytes], List[float]]] = {}
+        closing: List[DiskFile] = []
+        for f, data, enqueued in batch:
+            if data is None:
+                closing.append(f)
+                continue
+            data_list, enqueued_list = chunks.setdefault(f, ([], []))
+            data_list.append(data)
+            enqueued_list.append(enqueued)
+
+        for f, (data, enqueued) in chunks.items():
+            self._write(f, data, enqueued)
+
+        now = time.time()
+        with self._lock:
+            files = list(self._files)
+        for f in files:
+            if f in closing or f.unsynced_bytes == 0:
+                continue
+            if (self.fsync_bytes > 0 and f.unsynced_bytes >= self.fsync_bytes) or \
+               (self.fsync_interval_sec > 0 and now - f.last_sync >= self.fsync_interval_sec):
+                self._sync(f)
+
+        for f in closing:
+            self._close(f)
+
+    def _write(self, f: DiskFile, data: List[bytes], enqueued: List[float]) -> None:
+        if not data:
+            return
+        buf = data[0] if len(data) == 1 else b"".join(data)
+        view = memoryview(buf)
+        try:
+            # The file is unbuffered, a single write() may take only part of the buffer.
+            while view:
+                n = f.fd.write(view)
+                f.bytes_written += n
+                f.unsynced_bytes += n
+                self.bytes_written += n
+                self.write_calls += 1
+                view = view[n:]
+        except OSError:
+            logging.exception(f"Failed writing {len(view)} of {len(buf)} bytes to {f.path}")
+        now = time.time()
+        self._latencies.extend(now - t for t in enqueued)
+
+    def _sync(self, f: DiskFile) -> None:
+        try:
+            os.fsync(f.fd.fileno())
+            self.fsync_calls += 1
+        except OSError:
+            logging.exception(f"Failed to sync {f.path}")
+        f.unsynced_bytes = 0
+        f.last_sync = time.time()
+
+    def _close(self, f: DiskFile) -> None:
+        # Only the file list needs the lock; submitters do not wait for the fsync.
+        if f.unsynced_bytes:
+            self._sync(f)
+        f.fd.close()
+        with self._lock:
+            if f in self._files:
+                self._files.remove(f)
+        f._close_event.set()
+
+
+def open_file(writer: Optional[DiskWriter], path: str):
+    """Open path for binary writing through writer, or directly if there is no writer."""
+    return writer.open(path) if writer else open(path, "wb")
@@ -0,0 +1,184 @@
+"""Fragmented MP4 (ISO BMFF) muxing of an H.264 Annex B stream.
+
+The file starts with ftyp and a moov without samples. Frames follow in
+moof/mdat fragments that start at a keyframe or once "fragment_duration"
+seconds are buffered. Every fragment is self-contained, so a recording cut off
+by a power loss plays up to its last complete fragment.
+"""
+
+import struct
+from typing import BinaryIO, List, NamedTuple
+
+NAL_SLICE_IDR = 5
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+
+# trun sample flags
+_SAMPLE_FLAGS_SYNC = 0x02000000  # depends on no other sample
+_SAMPLE_FLAGS_NON_SYNC = 0x01010000  # depends on others, not a sync sample
+
+_MATRIX = struct.pack(">9I", 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0, 0x40000000)
+
+
+def box(box_type: bytes, *payload: bytes) -> bytes:
+    return struct.pack(">I4s", 8 + sum(len(p) for p in payload), box_type) + b"".join(payload)
+
+
+def full_box(box_type: bytes, version: int, flags: int, *payload: bytes) -> bytes:
+    return box(box_type, struct.pack(">I", (version << 24) | flags), *payload)
+
+
+def split_nal_units(data: bytes) -> List[memoryview]:
+    """Split an Annex B byte stream at its 3 or 4 byte start codes, without copying."""
+    view = memoryview(data)
+    units = []
+    start = data.find(b"\x00\x00\x01")
+    while start >= 0:
+        begin = start + 3
+        start = data.find(b"\x00\x00\x01", begin)
+        end = len(data) if start < 0 else start
+        # NAL units never end with a zero byte; those belong to the next start code.
+        while end > begin and data[end - 1] == 0:
+            end -= 1
+        if end > begin:
+            units.append(view[begin:end])
+    return units
+
+
+class Sample(NamedTuple):
+    units: List[memoryview]
+    dts: int
+    duration: int
+    keyframe: bool
+
+    @property
+    def size(self) -> int:
+        return sum(4 + len(u) for u in self.units)
+
+
+class FragmentedMP4Writer:
+    """Muxes complete H.264 access units, each with its capture time, into fragmented MP4.
+
+    Sample durations follow the differences of the capture times, so a variable
+    frame rate is kept. Output starts at the first keyframe after SPS and PPS
+    were seen.
+    """
+    def __init__(self, fd: BinaryIO, width: int, height: int, timescale: int=90000, fragment_duration: float=1.):
+        self.fd = fd
+        self.width = width
+        self.height = height
+        self.timescale = timescale
+        self.fragment_ticks = int(fragment_duration * timescale)
+
+        self.sps = None
+        self.pps = None
+        self.first_timestamp = None
+        self.sequence = 0
+        self.last_duration = timescale // 30
+        self._current = None  # Newest frame, its duration is known once the next one arrives
+        self._samples: List[Sample] = []
+
+    @property
+    def started(self) -> bool:
+        return self.first_timestamp is not None
+
+    def write_frame(self, data: bytes, timestamp: float) -> None:
+        units = []
+        keyframe = False
+        for unit in split_nal_units(data):
+            nal_type = unit[0] & 0x1f
+            if nal_type == NAL_SPS:
+                self.sps = bytes(unit)
+            elif nal_type == NAL_PPS:
+                self.pps = bytes(unit)
+            elif nal_type != NAL_AUD:
+                keyframe |= nal_type == NAL_SLICE_IDR
+                units.append(unit)
+        if not units:
+            return  # Parameter sets only; they go into the sample description
+
+        if not self.started:
+            if not keyframe or not self.sps or not self.pps:
+                return
+            self.fd.write(self._header())
+            self.first_timestamp = timestamp
+
+        dts = int(round((timestamp - self.first_timestamp) * self.timescale))
+        if self._current:
+            prev_units, prev_dts, prev_keyframe = self._current
+            dts = max(dts, prev_dts + 1)
+            self.last_duration = dts - prev_dts
+            self._samples.append(Sample(prev_units, prev_dts, self.last_duration, prev_keyframe))
+
+        if self._samples and (keyframe or dts - self._samples[0].dts >= self.fragment_ticks):
+            self._write_fragment()
+        self._current = (units, dts, keyframe)
+
+    def close(self) -> None:
+        if self._current:
+            units, dts, keyframe = self._current
+            self._samples.append(Sample(units, dts, self.last_duration, keyframe))
+            self._current = None
+        if self._samples:
+            self._write_fragment()
+
+    def _header(self) -> bytes:
+        ftyp = box(b"ftyp", b"isom", struct.pack(">I", 0x200), b"isom", b"iso2", b"iso6", b"avc1", b"mp41")
+
+        mvhd = full_box(b"mvhd", 0, 0,
+            struct.pack(">IIIIIH", 0, 0, self.timescale, 0, 0x00010000, 0x0100), bytes(10), _MATRIX,
+            bytes(24), struct.pack(">I", 2))
+        tkhd = full_box(b"tkhd", 0, 0x3,  # enabled, in movie
+            struct.pack(">IIIII", 0, 0, 1, 0, 0), bytes(8), struct.pack(">hhhH", 0, 0, 0, 0), _MATRIX,
+            struct.pack(">II", self.width << 16, self.height << 16))
+        mdhd = full_box(b"mdhd", 0, 0, struct.pack(">IIIIHH", 0, 0, self.timescale, 0, 0x55c4, 0))  # language "und"
+        hdlr = full_box(b"hdlr", 0, 0, struct.pack(">I4s", 0, b"vide"), bytes(12), b"VideoHandler\x00")
+
+        avcc = box(b"avcC",
+            bytes((1, self.sps[1], self.sps[2], self.sps[3], 0xff, 0xe1)),  # 4 byte lengths, one SPS
+            struct.pack(">H", len(self.sps)), self.sps,
+            bytes((1,)), struct.pack(">H", len(self.pps)), self.pps)
+        avc1 = box(b"avc1",
+            bytes(6), struct.pack(">H", 1),  # data reference index
+            bytes(16), struct.pack(">HHIIIH", self.width, self.height, 0x00480000, 0x00480000, 0, 1),
+            bytes(32), struct.pack(">Hh", 0x18, -1), avcc)
+        stbl = box(b"stbl",
+            full_box(b"stsd", 0, 0, struct.pack(">I", 1), avc1),
+            full_box(b"stts", 0, 0, struct.pack(">I", 0)),
+            full_box(b"stsc", 0, 0, struct.pack(">I", 0)),
+            full_box(b"stsz", 0, 0, struct.pack(">II", 0, 0)),
+            full_box(b"stco", 0, 0, struct.pack(">I", 0)))
+        minf = box(b"minf",
+            full_box(b"vmhd", 0, 1, struct.pack(">HHHH", 0, 0, 0, 0)),
+            box(b"dinf", full_box(b"dref", 0, 0, struct.pack(">I", 1), full_box(b"url ", 0, 1))),
+            stbl)
+        trak = box(b"trak", tkhd, box(b"mdia", mdhd, hdlr, minf))
+        mvex = box(b"mvex", full_box(b"trex", 0, 0, struct.pack(">IIIII", 1, 1, 0, 0, 0)))
+
+        return ftyp + box(b"moov", mvhd, trak, mvex)
+
+    def _moof(self, data_offset: int) -> bytes:
+        trun = [struct.pack(">Ii", len(self._samples), data_offset)]
+        for s in self._samples:
+            trun.append(struct.pack(">III", s.duration, s.size, _SAMPLE_FLAGS_SYNC if s.keyframe else _SAMPLE_FLAGS_NON_SYNC))
+
+        return box(b"moof",
+            full_box(b"mfhd", 0, 0, struct.pack(">I", self.sequence)),
+            box(b"traf",
+                full_box(b"tfhd", 0, 0x020000, struct.pack(">I", 1)),  # default-base-is-moof
+                full_box(b"tfdt", 1, 0, struct.pack(">Q", self._samples[0].dts)),
+                full_box(b"trun", 0, 0x000701, *trun)))  # data offset, sample duration, size and flags
+
+    def _write_fragment(self) -> None:
+        self.sequence += 1
+        moof_size = len(self._moof(0))
+        moof = self._moof(moof_size + 8)
+
+        parts = [moof, struct.pack(">I4s", 8 + sum(s.size for s in self._samples), b"mdat")]
+        for s in self._samples:
+            for unit in s.units:
+                parts.append(struct.pack(">I", len(unit)))
+                parts.append(unit)
+        self.fd.write(b"".join(parts))
+        self._samples = []
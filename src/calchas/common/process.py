@@ -0,0 +1,334 @@
+"""Hosting a sensor/output pair in a child process.
+
+The child runs the sensor and its output as usual and forwards the topics that
+subscribers in the recorder process asked for. Large buffers (frames, encoded
+video) are copied into a shared memory ring and only a small reference to the
+slot is pickled through the pipe.
+"""
+
+import copy
+import importlib
+import logging
+import multiprocessing
+import signal
+import struct
+import threading
+from multiprocessing import shared_memory
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from calchas.common import base, diskwriter
+
+_SLOT_HEADER = struct.Struct("<Q")
+
+
+class _SlotRef(NamedTuple):
+    """Stands in for a buffer that was placed in the ring."""
+    slot: int
+    seq: int
+    nbytes: int
+    shape: Optional[tuple]  # Set for NumPy arrays
+    dtype: Optional[str]
+
+
+class _Overwritten(Exception):
+    """The writer reused a ring slot before the reader copied it."""
+
+
+def _is_large_buffer(value: Any, min_bytes: int) -> bool:
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value) >= min_bytes
+    return hasattr(value, "__array_interface__") and value.nbytes >= min_bytes
+
+
+def _frame_bytes(options: Dict[str, Any]) -> int:
+    """Slot size for a BGR frame of the sensor's resolution, 3 MiB for sensors without one."""
+    if options.get("width") and options.get("height"):
+        return options["width"] * options["height"] * 3
+    return 3 * 1024 * 1024
+
+
+class ShmRing:
+    """Fixed-size slots in shared memory, overwritten round robin.
+
+    Each slot starts with the sequence number of the buffer it holds; it is 0
+    while the slot is being written. A reader checks it before and after
+    copying, so a slot the writer already reused is detected and skipped.
+    """
+    def __init__(self, shm: shared_memory.SharedMemory, slots: int, slot_bytes: int):
+        self.shm = shm
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.seq = 0
+
+    @staticmethod
+    def size(slots: int, slot_bytes: int) -> int:
+        return slots * (_SLOT_HEADER.size + slot_bytes)
+
+    def put(self, value) -> Optional[_SlotRef]:
+        data = memoryview(value).cast("B")
+        if data.nbytes > self.slot_bytes:
+            return None
+
+        self.seq += 1
+        slot = self.seq % self.slots
+        offset = slot * (_SLOT_HEADER.size + self.slot_bytes)
+        buf = self.shm.buf
+        _SLOT_HEADER.pack_into(buf, offset, 0)
+        buf[offset + _SLOT_HEADER.size:offset + _SLOT_HEADER.size + data.nbytes] = data
+        _SLOT_HEADER.pack_into(buf, offset, self.seq)
+
+        is_array = hasattr(value, "__array_interface__")
+        return _SlotRef(slot, self.seq, data.nbytes, value.shape if is_array else None, value.dtype.str if is_array else None)
+
+    def get(self, ref: _SlotRef) -> Optional[bytearray]:
+        offset = ref.slot * (_SLOT_HEADER.size + self.slot_bytes)
+        buf = self.shm.buf
+        if _SLOT_HEADER.unpack_from(buf, offset)[0] != ref.seq:
+            return None
+        data = bytearray(buf[offset + _SLOT_HEADER.size:offset + _SLOT_HEADER.size + ref.nbytes])
+        if _SLOT_HEADER.unpack_from(buf, offset)[0] != ref.seq:
+            return None
+        return data
+
+
+class _Forwarder(base.Subscriber):
+    """Sends the messages of the child's sensor to the recorder process."""
+    def __init__(self, options: Dict[str, Any], conn, ring: ShmRing):
+        super().__init__({
+            "name": f"{options['name']}-forwarder",
+            "queue_size": options.get("process_queue_size", 8),
+            "queue_policy": "drop_oldest",
+        })
+        self.conn = conn
+        self.ring = ring
+        self.min_shm_bytes = options.get("process_shm_min_bytes", 64 * 1024)
+        self.oversized = 0
+
+    def _start_impl(self):
+        pass
+
+    def _stop_impl(self):
+        pass
+
+    def on_process_message(self, msg: base.Message):
+        try:
+            self.conn.send((msg.topic, msg.timestamp, self._export(msg.data)))
+        except (BrokenPipeError, EOFError):
+            pass  # The recorder process is gone
+
+    def _export(self, value: Any) -> Any:
+        if isinstance(value, dict):
+            out = copy.copy(value)  # Keeps dict subclasses and their attributes
+            for k, v in value.items():
+                out[k] = self._export(v)
+            return out
+        if _is_large_buffer(value, self.min_shm_bytes):
+            ref = self.ring.put(value)
+            if ref is None:
+                if not self.oversized:
+                    logging.warning(f"{self.name}: {len(memoryview(value).cast('B'))} bytes exceed the shared memory slot size "
+                                    f"of {self.ring.slot_bytes}, sending them through the pipe (process_shm_slot_bytes)")
+                self.oversized += 1
+                return value
+            return ref
+        return value
+
+
+def _child_main(module_name: str, options: Dict[str, Any], writer_options: Optional[Dict[str, Any]], topics: List[str],
+                ctrl_conn, msg_conn, shm_name: str, slots: int, slot_bytes: int) -> None:
+    # Signals go to the whole process group; the recorder stops this process
+    # through the control pipe so the output files are finished properly.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logging.basicConfig(format=f"%(asctime)s %(levelname)s [{options['name']}]: %(message)s", level=logging.INFO)
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    ring = ShmRing(shm, slots, slot_bytes)
+    writer = None
+    pub = sub = forwarder = None
+    try:
+        module = importlib.import_module(module_name)
+        if writer_options:
+            writer = diskwriter.DiskWriter(writer_options)
+            writer.start()
+
+        pub = module.Sensor(options)
+        pub.writer = writer
+        sub = module.Output(options) if options.get("dry-run", False) is False else None
+        forwarder = _Forwarder(options, msg_conn, ring)
+
+        ok = forwarder.start()
+        for topic in topics:
+            pub.subscribe(forwarder, topic)
+        if ok and sub:
+            sub.writer = writer
+            for topic in sub.topics(pub):
+                pub.subscribe(sub, topic)
+            ok = sub.start()
+        ok = ok and pub.start()
+        ctrl_conn.send(("started", ok))
+
+        if ok:
+            while True:
+                try:
+                    request = ctrl_conn.recv()
+                except EOFError:
+                    logging.warning("Recorder process is gone, stopping")
+                    break
+                if request[0] != "adjust":
+                    break  # Stop request
+                pub.adjust(request[1])
+                if sub:
+                    sub.adjust(request[1])
+            pub.stop()
+
+        stats = {}
+        if sub:
+            pub.unsubscribe(sub)
+            sub.stop()
+            stats["dropped_messages"] = sub.dropped_messages
+        pub.unsubscribe(forwarder)
+        forwarder.stop()
+        if forwarder.dropped_messages:
+            logging.warning(f"Dropped {forwarder.dropped_messages} messages for subscribers in the recorder process")
+        if writer:
+            writer.stop()
+            stats["diskwriter"] = writer.stats()
+        ctrl_conn.send(("stopped", stats))
+    except Exception:
+        logging.exception(f"{options['name']} process failed")
+        try:
+            ctrl_conn.send(("failed", {}))
+        except (BrokenPipeError, EOFError):
+            pass
+    finally:
+        msg_conn.close()
+        ctrl_conn.close()
+        shm.close()
+
+
+class ProcessPublisher(base.Publisher):
+    """Stands in for a sensor, with its output, that runs in a child process.
+
+    Subscribers in this process receive the forwarded messages with their
+    original timestamps. After stop(), "stats" holds what the child reported
+    (dropped messages of its output, its disk writer stats).
+    """
+    def __init__(self, module_name: str, options: Dict[str, Any], writer_options: Optional[Dict[str, Any]]=None):
+        super().__init__(options)
+        self.module_name = module_name
+        self.writer_options = writer_options
+        self.stats = {}
+
+        # The topics depend on the options only; this instance is never started.
+        self._offer = importlib.import_module(module_name).Sensor(options).offer()
+
+        self._process = None
+        self._ctrl_conn = None
+        self._ctrl_lock = threading.Lock()  # adjust() may be called from another thread than stop()
+        self._msg_conn = None
+        self._shm = None
+        self._ring = None
+        self._receive_thread = None
+
+    def offer(self) -> List[str]:
+        return self._offer
+
+    def _start_impl(self):
+        if self._process:
+            return
+
+        slots = self.options.get("process_shm_slots", 8)
+        slot_bytes = self.options.get("process_shm_slot_bytes") or _frame_bytes(self.options)
+        self._shm = shared_memory.SharedMemory(create=True, size=ShmRing.size(slots, slot_bytes))
+        self._ring = ShmRing(self._shm, slots, slot_bytes)
+
+        ctx = multiprocessing.get_context("spawn")
+        self._ctrl_conn, child_ctrl_conn = ctx.Pipe()
+        self._msg_conn, child_msg_conn = ctx.Pipe(duplex=False)
+        topics = [t for t in self.offer() if self.has_subscribers(t)]
+        self._process = ctx.Process(
+            target=_child_main,
+            args=(self.module_name, self.options, self.writer_options, topics,
+                  child_ctrl_conn, child_msg_conn, self._shm.name, slots, slot_bytes),
+            name=self.name,
+        )
+        self._process.start()
+        child_ctrl_conn.close()
+        child_msg_conn.close()
+
+        self._receive_thread = threading.Thread(target=self._receive_thread_fn, name=f"{self.name}-receiver")
+        self._receive_thread.start()
+
+        timeout = self.options.get("process_start_timeout", 30.)
+        if not self._ctrl_conn.poll(timeout) or self._ctrl_conn.recv() != ("started", True):
+            self._shutdown()
+            raise RuntimeError(f"{self.name} did not start in its process")
+
+    def adjust(self, changes: Dict[str, Any]) -> bool:
+        # Applied by the sensor and its output in the child; whether they support it is not reported back.
+        with self._ctrl_lock:
+            if not self._process:
+                return False
+            try:
+                self._ctrl_conn.send(("adjust", changes))
+                return True
+            except (OSError, EOFError):
+                return False  # Stopped meanwhile
+
+    def _stop_impl(self):
+        if not self._process:
+            return
+        try:
+            with self._ctrl_lock:
+                self._ctrl_conn.send(("stop",))
+            if self._ctrl_conn.poll(self.options.get("process_stop_timeout", 30.)):
+                _, self.stats = self._ctrl_conn.recv()
+        except (BrokenPipeError, EOFError):
+            logging.error(f"{self.name} process ended unexpectedly")
+        self._shutdown()
+
+    def _shutdown(self):
+        self._process.join(5.)
+        if self._process.is_alive():
+            logging.error(f"{self.name} process did not exit, terminating it")
+            self._process.terminate()
+            self._process.join()
+        self._process = None
+
+        # The child closed its end of the message pipe, so the receiver sees EOF.
+        self._receive_thread.join()
+        self._receive_thread = None
+        self._ctrl_conn.close()
+        self._msg_conn.close()
+        self._ring = None
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+    def _receive_thread_fn(self):
+        while True:
+            try:
+                topic, timestamp, payload = self._msg_conn.recv()
+            except (EOFError, OSError):
+                break
+            try:
+                payload = self._import(payload)
+            except _Overwritten:
+                continue
+            self.publish(topic, payload, timestamp)
+
+    def _import(self, value: Any) -> Any:
+        if isinstance(value, dict):
+            for k, v in value.items():
+                value[k] = self._import(v)
+            return value
+        if isinstance(value, _SlotRef):
+            data = self._ring.get(value)
+            if data is None:
+                raise _Overwritten()
+            if value.shape is None:
+                return data
+            import numpy as np
+            return np.frombuffer(data, dtype=value.dtype).reshape(value.shape)
+        return value
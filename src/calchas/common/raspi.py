@@ -0,0 +1,80 @@
+"""Raspberry Pi health values from sysfs, without forking vcgencmd.
+
+The files stay open and are re-read with pread(), so a sample costs two
+syscalls. Values that do not exist on this machine read as None.
+"""
+
+import logging
+import os
+from typing import Optional
+
+MODEL_PATH = "/proc/device-tree/model"
+CPU_TEMP_PATH = "/sys/class/thermal/thermal_zone0/temp"
+THROTTLED_PATH = "/sys/devices/platform/soc/soc:firmware/get_throttled"
+
+# get_throttled flags (same as "vcgencmd get_throttled"). The upper half
+# reports what happened since boot.
+UNDER_VOLTAGE = 0x1
+FREQ_CAPPED = 0x2
+THROTTLED = 0x4
+SOFT_TEMP_LIMIT = 0x8
+UNDER_VOLTAGE_OCCURRED = 0x10000
+FREQ_CAPPED_OCCURRED = 0x20000
+THROTTLED_OCCURRED = 0x40000
+SOFT_TEMP_LIMIT_OCCURRED = 0x80000
+
+
+def is_raspberry_pi() -> bool:
+    try:
+        with open(MODEL_PATH, "rb") as f:
+            return f.read().startswith(b"Raspberry Pi")
+    except OSError:
+        return False
+
+
+class SysfsValue:
+    def __init__(self, path: str):
+        self.path = path
+        try:
+            self.fd = os.open(path, os.O_RDONLY)
+        except OSError as e:
+            logging.debug(f"{path} not available: {e}")
+            self.fd = None
+
+    @property
+    def available(self) -> bool:
+        return self.fd is not None
+
+    def read(self) -> Optional[str]:
+        if self.fd is None:
+            return None
+        try:
+            return os.pread(self.fd, 64, 0).decode("ascii").strip()
+        except OSError as e:
+            logging.debug(f"Failed reading {self.path}: {e}")
+            return None
+
+    def close(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class HealthSensors:
+    """CPU temperature in °C and the firmware's throttle flags (None off a Raspberry Pi)."""
+    def __init__(self):
+        self._temp = SysfsValue(CPU_TEMP_PATH)
+        self._throttled = SysfsValue(THROTTLED_PATH) if is_raspberry_pi() else None
+
+    def cpu_temp(self) -> Optional[float]:
+        value = self._temp.read()
+        return int(value) / 1000. if value else None
+
+    def throttled(self) -> Optional[int]:
+        value = self._throttled.read() if self._throttled else None
+        return int(value, 16) if value else None
+
+    def close(self) -> None:
+        self._temp.close()
+        if self._throttled:
+            self._throttled.close()
@@ -0,0 +1,166 @@
+"""Compact binary recording format for scalar sensor data.
+
+Layout (all integers little-endian):
+
+    file header:  MAGIC, u16 version, u32 schema length, u32 schema crc32, schema (utf-8 JSON)
+    block:        BLOCK_MAGIC, u32 record count, u32 payload crc32, payload
+
+The schema is a JSON object {"fields": [[name, type], ...]} where type is a
+struct format character. Every record in a payload is a fixed-width,
+little-endian struct of these fields. Blocks are appended one per flush, so a
+power cut only loses the block that was being written.
+"""
+
+import csv
+import json
+import logging
+import mmap
+import os
+import struct
+import zlib
+from typing import Any, BinaryIO, Dict, Iterable, List, Sequence, Tuple
+
+MAGIC = b"CALCHASR"
+VERSION = 1
+BLOCK_MAGIC = b"BLK1"
+
+# Struct format characters with a fixed size that NumPy interprets the same way.
+FIELD_TYPES = "bBhHiIqQfd"
+
+_FILE_HEADER = struct.Struct("<8sHII")
+_BLOCK_HEADER = struct.Struct("<4sII")
+
+Fields = List[Tuple[str, str]]
+
+
+def fields_from_keys(keys: Iterable[str], default: str="d", types: Dict[str, str]=None) -> Fields:
+    types = types or {}
+    return [(k, types.get(k, default)) for k in keys]
+
+
+class RecordWriter:
+    """Writes blocks of fixed-width records to an open binary file."""
+    def __init__(self, fd: BinaryIO, fields: Fields):
+        for name, t in fields:
+            if len(t) != 1 or t not in FIELD_TYPES:
+                raise ValueError(f"Unsupported type '{t}' for field '{name}'")
+
+        self.fd = fd
+        self.fields = list(fields)
+        self._struct = struct.Struct("<" + "".join(t for _, t in self.fields))
+        self._nan_row = [float("nan") if t in "fd" else 0 for _, t in self.fields]
+
+        schema = json.dumps({"fields": self.fields}).encode("utf-8")
+        self.fd.write(_FILE_HEADER.pack(MAGIC, VERSION, len(schema), zlib.crc32(schema)) + schema)
+
+    @property
+    def names(self) -> List[str]:
+        return [name for name, _ in self.fields]
+
+    def write_rows(self, rows: Sequence[Sequence[Any]]) -> None:
+        if not rows:
+            return
+
+        payload = bytearray(self._struct.size * len(rows))
+        offset = 0
+        for row in rows:
+            if None in row:
+                row = [self._nan_row[i] if v is None else v for i, v in enumerate(row)]
+            self._struct.pack_into(payload, offset, *row)
+            offset += self._struct.size
+
+        self.fd.write(_BLOCK_HEADER.pack(BLOCK_MAGIC, len(rows), zlib.crc32(payload)) + payload)
+
+
+def _read_header(buf) -> Tuple[Fields, int]:
+    magic, version, schema_len, schema_crc = _FILE_HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a calchas record file")
+    if version != VERSION:
+        raise ValueError(f"Unsupported record file version {version}")
+
+    schema = bytes(buf[_FILE_HEADER.size:_FILE_HEADER.size + schema_len])
+    if zlib.crc32(schema) != schema_crc:
+        raise ValueError("Record file schema is corrupt")
+    fields = [tuple(f) for f in json.loads(schema.decode("utf-8"))["fields"]]
+    return fields, _FILE_HEADER.size + schema_len
+
+
+def read_schema(path: str) -> Fields:
+    with open(path, "rb") as f:
+        header = f.read(_FILE_HEADER.size)
+        if len(header) < _FILE_HEADER.size:
+            return []  # Nothing was recorded
+        _, _, schema_len, _ = _FILE_HEADER.unpack(header)
+        return _read_header(header + f.read(schema_len))[0]
+
+
+def read(path: str, verify: bool=True):
+    """Memory-map a record file and return its records as a NumPy structured array.
+
+    Blocks with a bad CRC are skipped and a truncated last block is ignored.
+    The header is written with the first block, so a recording without samples
+    is shorter than it and reads as an empty array without fields.
+    """
+    # NumPy is only needed for reading; the writer has to run on bare devices.
+    import numpy as np
+
+    if os.path.getsize(path) < _FILE_HEADER.size:
+        return np.empty(0, dtype=[])
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        fields, offset = _read_header(mm)
+        dtype = np.dtype([(name, "<" + t) for name, t in fields])
+
+        blocks = []
+        while offset + _BLOCK_HEADER.size <= len(mm):
+            magic, count, crc = _BLOCK_HEADER.unpack_from(mm, offset)
+            if magic != BLOCK_MAGIC:
+                logging.warning(f"{path}: invalid block marker at offset {offset}, stopping")
+                break
+            begin = offset + _BLOCK_HEADER.size
+            end = begin + count * dtype.itemsize
+            if end > len(mm):
+                logging.warning(f"{path}: truncated block at offset {offset}, stopping")
+                break
+            if verify and zlib.crc32(mm[begin:end]) != crc:
+                logging.warning(f"{path}: CRC mismatch in block at offset {offset}, skipping")
+            else:
+                blocks.append(np.frombuffer(mm, dtype=dtype, count=count, offset=begin))
+            offset = end
+
+        # Copy out of the mapping and drop the views before it is closed.
+        records = np.concatenate(blocks) if blocks else np.empty(0, dtype=dtype)
+        del blocks
+        return records
+
+
+def convert_csv(csv_path: str, rec_path: str, fields: Fields=None, block_size: int=1000) -> int:
+    """Convert a sensor CSV file into a record file. Returns the number of records."""
+    def to_value(s: str, t: str):
+        if s in ("", "None"):
+            return None
+        return float(s) if t in "fd" else int(float(s))
+
+    count = 0
+    with open(csv_path, "r", newline="") as src, open(rec_path, "wb") as dst:
+        reader = csv.reader(src)
+        header = next(reader, None)
+        if header is None:
+            raise ValueError(f"{csv_path} is empty")
+
+        writer = RecordWriter(dst, fields or fields_from_keys(header))
+        if writer.names != header:
+            raise ValueError(f"Schema does not match the columns in {csv_path}")
+
+        types = [t for _, t in writer.fields]
+        rows = []
+        for row in reader:
+            rows.append([to_value(v, t) for v, t in zip(row, types)])
+            if len(rows) >= block_size:
+                writer.write_rows(rows)
+                count += len(rows)
+                rows.clear()
+        writer.write_rows(rows)
+        count += len(rows)
+    return count
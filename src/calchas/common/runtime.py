@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Callable, Coroutine, Iterator, Optional
+
+
+# Sensor loops are written as generators that do one unit of work and then yield
+# how many seconds to sleep. The same loop can then run on its own thread or as
+# a coroutine on the shared event loop.
+Steps = Iterator[float]
+
+
+def run_steps(steps: Steps) -> None:
+    for delay in steps:
+        if delay > 0:
+            time.sleep(delay)
+
+
+async def run_steps_async(steps: Steps) -> None:
+    try:
+        for delay in steps:
+            await asyncio.sleep(max(0., delay))
+    finally:
+        steps.close()
+
+
+class AsyncRuntime:
+    """Drives sensor coroutines on a single asyncio event loop in a background thread."""
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread = None
+
+    @property
+    def in_loop_thread(self) -> bool:
+        return self._thread is threading.current_thread()
+
+    def start(self) -> None:
+        if self.loop:
+            return
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop_thread_fn, name="asyncio")
+        self._thread.start()
+
+    def stop(self) -> None:
+        if not self.loop:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if not self.in_loop_thread:
+            self._thread.join()
+            self.loop.close()
+        self.loop = None
+        self._thread = None
+
+    def spawn(self, coro: Coroutine) -> asyncio.Task:
+        def create_task() -> asyncio.Task:
+            task = self.loop.create_task(coro)
+            task.add_done_callback(self._log_task_error)
+            return task
+
+        if self.in_loop_thread:
+            return create_task()
+
+        async def create_task_async() -> asyncio.Task:
+            return create_task()
+
+        return asyncio.run_coroutine_threadsafe(create_task_async(), self.loop).result()
+
+    def cancel(self, task: asyncio.Task) -> None:
+        """Cancel task and wait until it finished its cleanup.
+
+        Called from the event loop itself (e.g. a shutdown triggered by a
+        coroutine) this cannot wait and only requests the cancellation.
+        """
+        if self.in_loop_thread:
+            task.cancel()
+            return
+        if not self.loop or task.done():
+            return
+
+        async def cancel_and_wait():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            except Exception:
+                pass  # Already logged by _log_task_error
+
+        asyncio.run_coroutine_threadsafe(cancel_and_wait(), self.loop).result()
+
+    def _loop_thread_fn(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    @staticmethod
+    def _log_task_error(task: asyncio.Task) -> None:
+        if not task.cancelled() and task.exception():
+            logging.error("Sensor coroutine failed", exc_info=task.exception())
+
+
+class Worker:
+    """Runs a step loop on its own thread, or as a task on the shared AsyncRuntime if there is one.
+
+    In thread mode the owner has to make the loop return (e.g. with a stop flag)
+    before calling stop(); a task is cancelled at its next sleep.
+    """
+    def __init__(self, name: str, steps_fn: Callable[[], Steps], runtime: AsyncRuntime=None):
+        self.name = name
+        self.steps_fn = steps_fn
+        self.runtime = runtime
+        self._thread = None
+        self._task = None
+
+    @property
+    def running(self) -> bool:
+        return bool(self._thread or self._task)
+
+    def start(self) -> None:
+        if self.running:
+            return
+        if self.runtime:
+            self._task = self.runtime.spawn(run_steps_async(self.steps_fn()))
+        else:
+            self._thread = threading.Thread(target=lambda: run_steps(self.steps_fn()), name=self.name)
+            self._thread.start()
+
+    def stop(self) -> None:
+        if self._task:
+            self.runtime.cancel(self._task)
+            self._task = None
+        if self._thread:
+            if self._thread is not threading.current_thread():
+                self._thread.join()
+            self._thread = None
@@ -0,0 +1,79 @@
+"""Keyframe index for raw H264 recordings.
+
+The index is a record file (see recfile) with one record per point where
+decoding can start: the SPS header in front of a keyframe, or the keyframe
+itself if the encoder does not repeat its headers.
+"""
+
+import bisect
+import mmap
+import os
+from typing import BinaryIO, List, Tuple
+
+from calchas.common import recfile
+
+FIELDS = [("timestamp", "d"), ("offset", "Q"), ("frame_num", "I"), ("frame_type", "B")]
+
+
+class IndexWriter:
+    def __init__(self, fd: BinaryIO, block_size: int=10):
+        self.fd = fd
+        self.block_size = block_size
+        self.writer = recfile.RecordWriter(fd, FIELDS)
+        self.rows = []
+
+    def add(self, timestamp: float, offset: int, frame_num: int, frame_type: int) -> None:
+        self.rows.append((timestamp, offset, frame_num, frame_type))
+        if len(self.rows) >= self.block_size:
+            self.flush()
+
+    def flush(self) -> None:
+        self.writer.write_rows(self.rows)
+        self.rows = []
+
+    def close(self) -> None:
+        self.flush()
+        self.fd.close()
+
+
+class VideoReader:
+    """Random access into a raw H264 recording through its keyframe index."""
+    def __init__(self, video_path: str, index_path: str):
+        index = recfile.read(index_path)
+        self.timestamps: List[float] = index["timestamp"].tolist()
+        self.offsets: List[int] = index["offset"].tolist()
+
+        self._fd = open(video_path, "rb")
+        # An empty file (the camera stopped before its first chunk) cannot be mapped; it has no frames.
+        if os.fstat(self._fd.fileno()).st_size == 0:
+            self._mm = b""
+            self.timestamps, self.offsets = [], []
+        else:
+            self._mm = mmap.mmap(self._fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self) -> "VideoReader":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._fd.close()
+
+    def byte_range(self, timestamp: float) -> Tuple[int, int]:
+        """Byte range from the last keyframe at or before timestamp up to the next keyframe.
+
+        Decoding it from the start yields the frame closest to timestamp.
+        """
+        if not self.offsets:
+            return 0, len(self._mm)
+        i = max(0, bisect.bisect_right(self.timestamps, timestamp) - 1)
+        end = self.offsets[i + 1] if i + 1 < len(self.offsets) else len(self._mm)
+        return self.offsets[i], end
+
+    def read(self, timestamp: float) -> memoryview:
+        begin, end = self.byte_range(timestamp)
+        # A view into the mapping; release or copy it before closing the reader.
+        return memoryview(self._mm)[begin:end]
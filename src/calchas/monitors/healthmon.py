@@ -1,14 +1,18 @@
+import collections
+import csv
 import datetime
+import io
 import logging
+import os
 import queue
 import shutil
 import signal
 import sys
 import threading
 import time
-from typing import Any, Dict
+from typing import Any, Callable, Deque, Dict, Iterable, List, Tuple
 
-from calchas.common import base
+from calchas.common import base, diskwriter, raspi, runtime
 
 
 class Monitor(base.Subscriber):
@@ -16,11 +20,59 @@ class Monitor(base.Subscriber):
         super().__init__(options)
         self.request_stop = False
 
-        self._health_check_thread = None
+        self._health_check_worker = None
         self._shutdown_callbacks = []
+        self._dropped: Dict[str, int] = {}
+
+        # Quality tiers: 0 is the configured state, tier N applies the Nth entry
+        # of the tier list of its kind. See _apply_tiers().
+        self.components_fn: Callable[[], Iterable[Any]] = None
+        self._tier_options: Dict[str, List[Dict[str, Dict[str, Any]]]] = {
+            "disk": self.options.get("quality_tiers", []),
+            "thermal": self.options.get("thermal_tiers", []),
+        }
+        self._tiers = {kind: 0 for kind in self._tier_options}
+        self._last_transition = {kind: 0. for kind in self._tier_options}
+        self._applied: Dict[Any, Dict[str, Any]] = {}  # component -> options it was adjusted to
+        self._log_fd = None
+        self._start_time = 0.
+
+        self._disk_samples: Deque[Tuple[float, int, Dict[str, int]]] = collections.deque()  # (time, free bytes, bytes per output file)
+        self._disk_tier_rates: Dict[int, float] = {}  # Write rate measured when a tier was left for a lower one
+        self.disk_time_left_sec = None
+
+        self.health = None
+        self._throttle_flags = 0  # Current (lower) half of the firmware's throttle flags
+
+    def watch(self, components_fn: Callable[[], Iterable[Any]]) -> None:
+        self.components_fn = components_fn
+
+    def topics(self, publisher: base.Publisher) -> List[str]:
+        # The health check does not use sensor data, only the bus telemetry.
+        return [t for t in publisher.offer() if t == "telemetry"]
 
     def on_process_message(self, msg: base.Message):
-        logging.debug(f"Monitor msg from {msg.sensor.name}")
+        if msg.topic == "telemetry":
+            self._check_telemetry(msg.data)
+        else:
+            logging.debug(f"Monitor msg from {msg.sensor.name}")
+
+    def _check_telemetry(self, rows: List[Dict[str, Any]]):
+        backlog_threshold = self.options.get("backlog_threshold", 0.8)
+        latency_threshold_ms = self.options.get("latency_threshold_ms", 2000)
+        for row in rows:
+            if row["kind"] != "subscriber":
+                continue
+            name = row["name"]
+            dropped = row["dropped"] - self._dropped.get(name, 0)
+            self._dropped[name] = row["dropped"]
+            if dropped > 0:
+                logging.warning(f"{name} dropped {dropped} messages")
+            if row["queue_size"] and row["queue_depth"] >= backlog_threshold * row["queue_size"]:
+                logging.warning(f"{name} is falling behind, {row['queue_depth']} of {row['queue_size']} messages queued")
+            if row["latency_max_ms"] > latency_threshold_ms:
+                logging.warning(f"{name} stalled, messages were handled up to {row['latency_max_ms']:.0f}ms late "
+                                f"(slowest callback {row['processing_max_ms']:.0f}ms)")
 
     def on_signal(self, signal_number=0, stack_frame=None):
         logging.info(f"Signal received {signal_number}. Informing {len(self._shutdown_callbacks)} listeners.")
@@ -34,13 +86,19 @@ class Monitor(base.Subscriber):
 
     def _start_impl(self):
         self.request_stop = False
+        self._start_time = time.time()
+        self.health = raspi.HealthSensors()
+        self._throttle_flags = 0
+        if self.options.get("output"):
+            self._log_fd = diskwriter.open_file(self.writer, os.path.join(self.out_dir, self.options["output"]))
+            self._log_fd.write(b"timestamp,kind,from_tier,to_tier,reason\n")
 
         self._run_health_check()
         if self.request_stop:
             raise OSError("Failed to start health monitor because initial health check failed.")
 
-        self._health_check_thread = threading.Thread(target=self._health_check_thread_fn)
-        self._health_check_thread.start()
+        self._health_check_worker = runtime.Worker(self.name, self._health_check_steps, self.runtime)
+        self._health_check_worker.start()
 
         self._orig_handler_sigint = signal.signal(signal.SIGINT, self.on_signal)
         self._orig_handler_sigterm = signal.signal(signal.SIGTERM, self.on_signal)
@@ -48,9 +106,9 @@ class Monitor(base.Subscriber):
     def _stop_impl(self):
         self.request_stop = True
 
-        if self._health_check_thread:
-            self._health_check_thread.join()
-            self._health_check_thread = None
+        if self._health_check_worker:
+            self._health_check_worker.stop()
+            self._health_check_worker = None
 
         # FIXME: when shutting down via GPIO Button
         # ERROR: Error stopping healthmon
@@ -62,29 +120,165 @@ class Monitor(base.Subscriber):
         #   File "/usr/lib/python3.7/signal.py", line 47, in signal
         #     handler = _signal.signal(_enum_to_int(signalnum), _enum_to_int(handler))
         # ValueError: signal only works in main thread
+        if self._log_fd:
+            self._log_fd.close()
+            self._log_fd = None
+
+        if self.health:
+            self.health.close()
+            self.health = None
+
         signal.signal(signal.SIGINT, self._orig_handler_sigint)
         signal.signal(signal.SIGTERM, self._orig_handler_sigterm)
 
-    def _health_check_thread_fn(self):
+    def _health_check_steps(self) -> runtime.Steps:
         frequency_sleep_sec = 1. / self.options.get("frequency", 1.)
         while not self.request_stop:
             self._run_health_check()
 
             if self.request_stop:
-                logging.info(f"Health check failed. Informing {len(self._shutdown_callbacks)} listeners.")
-                for cb in self._shutdown_callbacks:
-                    cb()
+                # The callbacks stop the recorder, which stops this loop too. Run
+                # them on their own thread so neither a thread nor the event loop
+                # has to wait for itself.
+                threading.Thread(target=self._notify_shutdown, name=f"{self.name}-shutdown").start()
                 break
 
-            time.sleep(frequency_sleep_sec - time.time() % frequency_sleep_sec)
+            yield frequency_sleep_sec - time.time() % frequency_sleep_sec
+
+    def _notify_shutdown(self):
+        logging.info(f"Health check failed. Informing {len(self._shutdown_callbacks)} listeners.")
+        for cb in self._shutdown_callbacks:
+            cb()
 
     def _run_health_check(self):
         if self.request_stop:
             return
 
-        total, used, _free = shutil.disk_usage(self.options["out_dir"])
+        total, used, free = shutil.disk_usage(self.options["out_dir"])
         percent = round((used / total) * 100., 1)
 
         if not self.dry_run and (percent > self.options["disk_usage_threshold"]):
             logging.info(f"Shutting down because disk usage is at {percent}% ({self.options['disk_usage_threshold']}% allowed)")
             self.request_stop = True
+            return
+
+        self._check_disk_budget(total, free)
+        self._check_thermal()
+
+    def _check_disk_budget(self, total: int, free: int):
+        # Steps through the quality tiers so the disk lasts for the rest of the expected drive.
+        now = time.time()
+        files = self.writer.file_stats() if self.writer else {}
+        self._disk_samples.append((now, free, files))
+        window = self.options.get("rate_window_sec", 60.)
+        while len(self._disk_samples) > 2 and now - self._disk_samples[1][0] >= window:
+            self._disk_samples.popleft()
+        first_time, first_free, first_files = self._disk_samples[0]
+        elapsed = now - first_time
+        if elapsed < window / 2:
+            return  # Too little history for a rate
+
+        output_rates = {path: (written - first_files.get(path, 0)) / elapsed for path, written in files.items()}
+        # Outputs in other processes or writing on their own only show up in the free space.
+        rate = max((first_free - free) / elapsed, sum(output_rates.values()))
+        reserve = total * (100. - self.options["disk_usage_threshold"]) / 100.
+        time_left = (free - reserve) / rate if rate > 0 else float("inf")
+        needed = max(self.options.get("expected_drive_min", 240.) * 60. - (now - self._start_time),
+                     self.options.get("min_time_left_min", 30.) * 60.)
+        self.disk_time_left_sec = time_left
+
+        tier = self._tiers["disk"]
+        if now - self._last_transition["disk"] < self.options.get("tier_dwell_sec", 120.):
+            return
+        if time_left < needed and tier < len(self._tier_options["disk"]):
+            self._disk_tier_rates[tier] = rate
+            tier += 1
+        elif tier > 0 and (free - reserve) / max(rate, self._disk_tier_rates.get(tier - 1, rate), 1.) > \
+                self.options.get("restore_factor", 1.5) * needed:
+            tier -= 1
+        else:
+            return
+
+        top = sorted(output_rates.items(), key=lambda item: -item[1])[:3]
+        outputs = ", ".join(f"{os.path.basename(path)} {r / 1e6:.2f}MB/s" for path, r in top)
+        self._set_tier("disk", tier, f"{free / 1e6:.0f}MB free, writing {rate / 1e6:.2f}MB/s ({outputs}), "
+                                     f"{time_left / 60.:.0f}min left, {needed / 60.:.0f}min needed")
+        self._disk_samples.clear()  # The rate changes with the tier
+
+    def _check_thermal(self):
+        # Steps through the thermal tiers while the Pi is hot, throttled or under-voltage (less load draws less current).
+        temp = self.health.cpu_temp()
+        flags = self.health.throttled()
+        if temp is None and flags is None:
+            return  # Neither is available on this machine
+
+        flags = (flags or 0) & (raspi.UNDER_VOLTAGE | raspi.FREQ_CAPPED | raspi.THROTTLED | raspi.SOFT_TEMP_LIMIT)
+        temp_text = f"{temp:.1f}°C" if temp is not None else "temperature unknown"
+        if flags != self._throttle_flags:
+            self._log_transition("throttle", self._throttle_flags, flags, f"{temp_text}, {self._describe_flags(flags)}")
+            self._throttle_flags = flags
+
+        tier = self._tiers["thermal"]
+        tiers = self._tier_options["thermal"]
+        threshold = self.options.get("temperature_threshold")
+        if threshold and temp is not None and temp > threshold and tier >= len(tiers) and not self.dry_run:
+            logging.info(f"Shutting down because the CPU is at {temp_text} ({threshold}°C allowed)")
+            self.request_stop = True
+            return
+
+        if time.time() - self._last_transition["thermal"] < self.options.get("thermal_dwell_sec", 30.):
+            return
+        hot = temp is not None and temp >= self.options.get("thermal_step_down_temp", 75.)
+        cool = (temp is None or temp < self.options.get("thermal_restore_temp", 65.)) and not flags
+        if (hot or flags) and tier < len(tiers):
+            self._set_tier("thermal", tier + 1, f"{temp_text}, {self._describe_flags(flags)}")
+        elif cool and tier > 0:
+            self._set_tier("thermal", tier - 1, f"{temp_text}, {self._describe_flags(flags)}")
+
+    @staticmethod
+    def _describe_flags(flags: int) -> str:
+        names = [name for bit, name in [(raspi.UNDER_VOLTAGE, "under-voltage"), (raspi.FREQ_CAPPED, "frequency capped"),
+                                        (raspi.THROTTLED, "throttled"), (raspi.SOFT_TEMP_LIMIT, "soft temperature limit")]
+                 if flags & bit]
+        return ", ".join(names) if names else "not throttled"
+
+    def _set_tier(self, kind: str, tier: int, reason: str):
+        previous = self._tiers[kind]
+        self._tiers[kind] = tier
+        self._last_transition[kind] = time.time()
+        self._log_transition(kind, previous, tier, reason)
+        if not self.dry_run:
+            self._apply_tiers()
+
+    def _log_transition(self, kind: str, previous: int, current: int, reason: str):
+        logging.warning(f"{kind} {previous} -> {current}: {reason}")
+        if self._log_fd:
+            buf = io.StringIO()
+            csv.writer(buf).writerow([time.time(), kind, previous, current, reason])
+            self._log_fd.write(buf.getvalue().encode("utf-8"))
+
+    def _apply_tiers(self):
+        # Configured options, overridden by the active tier of each kind (thermal wins over disk).
+        targets: Dict[str, Dict[str, Any]] = {}
+        keys = set()
+        for kind, tier_options in self._tier_options.items():
+            for entry in tier_options:
+                keys.update(entry)
+            if self._tiers[kind] > 0:
+                for key, changes in tier_options[self._tiers[kind] - 1].items():
+                    targets.setdefault(key, {}).update(changes)
+
+        for c in (self.components_fn() if self.components_fn else []):
+            if c is self:
+                continue
+            target = {}
+            for key in keys:
+                if key in (c.name, c.options.get("module")):
+                    for kind, tier_options in self._tier_options.items():
+                        for entry in tier_options:
+                            target.update({k: c.options[k] for k in entry.get(key, {}) if k in c.options})
+                    target.update({k: v for k, v in targets.get(key, {}).items() if k in c.options})
+            if target and target != self._applied.get(c, {}):
+                if c.adjust(target):
+                    logging.info(f"{c.name} adjusted to {target}")
+                self._applied[c] = target
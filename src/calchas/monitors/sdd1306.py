@@ -1,5 +1,4 @@
 import logging
-import threading
 import time
 from typing import Any, Dict, List, Union
 
@@ -11,7 +10,7 @@ from PIL import Image, ImageDraw, ImageFont
 import gpiozero
 
 from calchas import utils
-from calchas.common import base
+from calchas.common import base, runtime
 
 
 def _readable_bytes(num: int) -> str:
@@ -33,6 +32,9 @@ class ScreenBase:
         self.img = Image.new("1", (self.options["width"], self.options["height"]))
         self.img_draw = ImageDraw.Draw(self.img)
 
+    def topics(self, publisher: base.Publisher) -> List[str]:
+        return publisher.offer() if self.sensor_name == publisher.name else []
+
     def wants(self, msg: base.Message) -> bool:
         return self.sensor_name == msg.sensor.name
 
@@ -57,6 +59,9 @@ class SystemInfoScreen(ScreenBase):
         self._mode_idx = 0
         self._modes = 2
 
+    def topics(self, publisher: base.Publisher) -> List[str]:
+        return [t for t in super().topics(publisher) if t != "threads"]
+
     def frame(self) -> Image:
         self.clear()
         left, top, lineh = 0, -2, 8
@@ -112,12 +117,23 @@ class PiCamScreen(ScreenBase):
     def __init__(self, options: Dict[str, Any], model: Any=None):
         super().__init__(options, model)
 
+        self.preview = None
         self._mode_idx = 0
         self._modes = [
             self._camera_stats,
             self._camera_preview,
         ]
 
+    def topics(self, publisher: base.Publisher) -> List[str]:
+        # Frame info and preview, never the encoded video.
+        return [t for t in super().topics(publisher) if t != "all"]
+
+    def update_model(self, model: Any) -> None:
+        if model.topic == "preview":
+            self.preview = model.data
+        else:
+            self.model = model
+
     def frame(self) -> Image:
         return self._modes[self._mode_idx]()
 
@@ -133,21 +149,20 @@ class PiCamScreen(ScreenBase):
         self.img_draw.text(((w - header_w) / 2, top), "PICAM", font=self.font, fill=255)
 
         if self.model:
-            self.img_draw.text((left, top + (1 * lineh)), f"Frame Type: {self.model.data['frame'].frame_type}",  font=self.font, fill=255)
-            self.img_draw.text((left, top + (2 * lineh)), f"Frame Complete: {self.model.data['frame'].complete}",  font=self.font, fill=255)
-            self.img_draw.text((left, top + (3 * lineh)), f"Frame Size: {_readable_bytes(self.model.data['frame'].frame_size)}",  font=self.font, fill=255)
-            self.img_draw.text((left, top + (4 * lineh)), f"Video Size: {_readable_bytes(self.model.data['frame'].video_size)}",  font=self.font, fill=255)
+            self.img_draw.text((left, top + (1 * lineh)), f"Frame Type: {self.model.data.frame_type}",  font=self.font, fill=255)
+            self.img_draw.text((left, top + (2 * lineh)), f"Frame Complete: {self.model.data.complete}",  font=self.font, fill=255)
+            self.img_draw.text((left, top + (3 * lineh)), f"Frame Size: {_readable_bytes(self.model.data.frame_size)}",  font=self.font, fill=255)
+            self.img_draw.text((left, top + (4 * lineh)), f"Video Size: {_readable_bytes(self.model.data.video_size)}",  font=self.font, fill=255)
 
         return self.img
 
     def _camera_preview(self):
-        if not self.model or not self.model.data.get("preview", None):
+        if not self.preview:
             self.clear()
             return self.img
 
-        # TODO: define what format the preview image is in
-        #image = PIL.Image.open(io.BytesIO(self.model.data['preview']))
-        return self.model.data["preview"].resize((128, 64)).convert("1")
+        # Greyscale image from the camera's preview port
+        return self.preview.resize(self.img.size).convert("1")
 
 
 class WebcamScreen(ScreenBase):
@@ -182,9 +197,11 @@ class ImuScreen(ScreenBase):
         self.img_draw.text(((w - header_w) / 2, top), "IMU", font=self.font, fill=255)
 
         if self.model:
-            self.img_draw.text((left, top + (1 * lineh)), f"GYRO: x={self.model.data['gyro_x']:.1f} y={self.model.data['gyro_y']:.1f} z={self.model.data['gyro_z']:.1f}",  font=self.font, fill=255)
-            self.img_draw.text((left, top + (2 * lineh)), f"ACC: x={self.model.data['acc_x']:.1f} y={self.model.data['acc_y']:.1f} z={self.model.data['acc_z']:.1f}",  font=self.font, fill=255)
-            self.img_draw.text((left, top + (3 * lineh)), f"ROT: x={self.model.data['rot_x']:.1f} y={self.model.data['rot_y']:.1f}",  font=self.font, fill=255)
+            # FIFO mode publishes batches; show the newest sample.
+            data = self.model.data[-1] if self.model.topic == "batch" else self.model.data
+            self.img_draw.text((left, top + (1 * lineh)), f"GYRO: x={data['gyro_x']:.1f} y={data['gyro_y']:.1f} z={data['gyro_z']:.1f}",  font=self.font, fill=255)
+            self.img_draw.text((left, top + (2 * lineh)), f"ACC: x={data['acc_x']:.1f} y={data['acc_y']:.1f} z={data['acc_z']:.1f}",  font=self.font, fill=255)
+            self.img_draw.text((left, top + (3 * lineh)), f"ROT: x={data['rot_x']:.1f} y={data['rot_y']:.1f}",  font=self.font, fill=255)
 
         return self.img
 
@@ -193,6 +210,10 @@ class GpsScreen(ScreenBase):
     def __init__(self, options: Dict[str, Any], model: Any=None):
         super().__init__(options, model)
 
+    def topics(self, publisher: base.Publisher) -> List[str]:
+        # Position fixes only; other sentence types are then not even parsed.
+        return [t for t in super().topics(publisher) if t in ("GGA", "PVT")]
+
     def frame(self) -> Image:
         self.clear()
         left, top, lineh = 0, -2, 8
@@ -205,6 +226,8 @@ class GpsScreen(ScreenBase):
             self.img_draw.text((left, top + (1 * lineh)), f"Lat: {self.model.data.latitude or 0.0}",  font=self.font, fill=255)
             self.img_draw.text((left, top + (2 * lineh)), f"Lon: {self.model.data.longitude or 0.0}",  font=self.font, fill=255)
             self.img_draw.text((left, top + (3 * lineh)), f"Alt: {self.model.data.altitude or 0.0}",  font=self.font, fill=255)
+            if hasattr(self.model.data, "ground_speed"):
+                self.img_draw.text((left, top + (4 * lineh)), f"Spd: {self.model.data.ground_speed * 3.6:.1f} km/h Sats: {self.model.data.num_sv}",  font=self.font, fill=255)
 
         return self.img
 
@@ -214,6 +237,7 @@ class Menu:
         self.options = options
         self.flip_fn = flip_fn
         self.font = ImageFont.load_default()
+        self.screen_names: List[str] = []
         self.screens: List[ScreenBase] = []
         self.screen_idx = 0
 
@@ -232,9 +256,8 @@ class Menu:
             self.btn_mode.when_pressed = self.mode
 
     def add_screen(self, screen_name: str):
-        screen = self._create_screen(screen_name)
-        if screen:
-            self.screens.append(screen)
+        # The screen is created once the sensor of that name shows up in topics().
+        self.screen_names.append(screen_name)
 
     def prev(self):
         if self.screens:
@@ -248,6 +271,19 @@ class Menu:
         if self.screens and self.screen_idx < len(self.screens):
             self.screens[self.screen_idx].mode()
 
+    def topics(self, publisher: base.Publisher) -> List[str]:
+        if publisher.name in self.screen_names and not any(s.sensor_name == publisher.name for s in self.screens):
+            # The sensor module decides the screen, instances may have any name.
+            screen = self._create_screen(publisher.options.get("module", publisher.name), publisher.name)
+            if screen:
+                self.screens.append(screen)
+                self.screens.sort(key=lambda s: self.screen_names.index(s.sensor_name))
+
+        topics = []
+        for screen in self.screens:
+            topics += [t for t in screen.topics(publisher) if t not in topics]
+        return topics
+
     def update(self, msg: base.Message):
         for screen in self.screens or []:
             if screen.wants(msg):
@@ -255,21 +291,22 @@ class Menu:
                 break
 
     def display(self):
+        if self.screens:
             self.flip_fn(self.screens[self.screen_idx].frame())
 
-    def _create_screen(self, name: str) -> ScreenBase:
-        if name == "systeminfo":
+    def _create_screen(self, module: str, name: str) -> ScreenBase:
+        if module == "systeminfo":
             return SystemInfoScreen(name, self.options)
-        elif name == "picam":
+        elif module == "picam":
             return PiCamScreen(name, self.options)
-        elif name == "webcam":
+        elif module == "webcam":
            return WebcamScreen(name, self.options)
-        elif name == "imu":
+        elif module == "imu":
             return ImuScreen(name, self.options)
-        elif name == "gps":
+        elif module == "gps":
             return GpsScreen(name, self.options)
         else:
-            logging.error(f"Unknown screen {name}")
+            logging.error(f"Unknown screen {name} ({module})")
             return None
 
 
@@ -278,12 +315,16 @@ class Monitor(base.Subscriber):
         super().__init__(options)
         self.request_stop = False
 
-        self._render_thread = None
+        self._render_worker = None
 
         self.bus = None
         self.disp = None
         self.menu = None
 
+    def topics(self, publisher: base.Publisher) -> List[str]:
+        # Only what the configured screens display.
+        return self.menu.topics(publisher) if self.menu else []
+
     def on_process_message(self, msg: base.Message):
         self.menu.update(msg)
 
@@ -297,15 +338,15 @@ class Monitor(base.Subscriber):
         for sensor_name in self.options.get("screens", []):
             self.menu.add_screen(sensor_name)
 
-        self._render_thread = threading.Thread(target=self._render_thread_fn)
-        self._render_thread.start()
+        self._render_worker = runtime.Worker(self.name, self._render_steps, self.runtime)
+        self._render_worker.start()
 
     def _stop_impl(self):
         self.request_stop = True
 
-        if self._render_thread:
-            self._render_thread.join()
-            self._render_thread = None
+        if self._render_worker:
+            self._render_worker.stop()
+            self._render_worker = None
 
         self.menu = None
 
@@ -313,9 +354,9 @@ class Monitor(base.Subscriber):
         self.disp = None
         self.bus = None
 
-    def _render_thread_fn(self):
+    def _render_steps(self) -> runtime.Steps:
         sleep_sec = 1. / self.options.get("framerate", 1.)
 
         while not self.request_stop:
             self.menu.display()
-            time.sleep(sleep_sec - time.time() % sleep_sec)
+            yield sleep_sec - time.time() % sleep_sec
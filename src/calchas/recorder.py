@@ -1,9 +1,10 @@
+import copy
 import importlib
 import logging
 from typing import Any, Dict, List, Tuple
 
 from calchas import trip, utils
-from calchas.common import base
+from calchas.common import base, diskwriter, process, runtime
 
 
 class Recorder:
@@ -13,6 +14,8 @@ class Recorder:
         self.trip = trip
         self.monitors: List[base.Subscriber] = []
         self.sensors: List[Tuple[base.Publisher, base.Subscriber]] = []
+        self.writer: diskwriter.DiskWriter = None
+        self.runtime: runtime.AsyncRuntime = None
         self.running = False
 
     def start(self):
@@ -20,6 +23,8 @@ class Recorder:
             logging.warning("Trying to start a recorder that is already running")
             return
         logging.info("Starting Recorder")
+        self._start_writer()
+        self._start_runtime()
         self._start_monitors()
         self._start_sensors()
         self.running = True
@@ -32,9 +37,39 @@ class Recorder:
         logging.info("Stopping Recorder")
         self._stop_sensors()
         self._stop_monitors()
+        self._stop_runtime()
+        self._stop_writer()
+        self.trip.save_options()
         self.running = False
         logging.info("Data recording stopped")
 
+    def _start_writer(self):
+        options = self.trip.options.get("diskwriter", {})
+        if options.get("active", False):
+            self.writer = diskwriter.DiskWriter(options)
+            self.writer.start()
+
+    def _stop_writer(self):
+        if self.writer:
+            self.writer.stop()
+            stats = self.writer.stats()
+            logging.info(f"Disk writer stats: {stats}")
+            self.trip.options.setdefault("stats", {})["diskwriter"] = stats
+            self.writer = None
+
+    def _start_runtime(self):
+        name = self.trip.options.get("recorder", {}).get("runtime", "threads")
+        if name == "asyncio":
+            self.runtime = runtime.AsyncRuntime()
+            self.runtime.start()
+        elif name != "threads":
+            logging.warning(f"Unknown runtime '{name}', using threads")
+
+    def _stop_runtime(self):
+        if self.runtime:
+            self.runtime.stop()
+            self.runtime = None
+
     def _start_monitors(self):
         monitors = []
         for name, options in self.trip.options.get("monitors", {}).items():
@@ -49,6 +84,8 @@ class Recorder:
             # TODO: handles this using healthmon options
             if mon.name == "healthmon":
                 mon.register_shutdown_callback(self.stop)
+            if hasattr(mon, "watch"):
+                mon.watch(self._bus_components)
 
             self.monitors.append(mon)
             logging.info(f"{mon.name} started.")
@@ -57,6 +94,7 @@ class Recorder:
         for mon in reversed(self.monitors):
             logging.info(f"Stopping {mon.name}...")
             mon.stop()
+            self._record_dropped_messages(mon)
             logging.info(f"{mon.name} stopped.")
         self.monitors = []
 
@@ -64,14 +102,20 @@ class Recorder:
         sensors: Tuple[base.Publisher, base.Subscriber] = []
         for name, options in self.trip.options.get("sensors", {}).items():
             if options.get("active", False):
-                sensors.append(self._create_sensor_instance(name, options))
+                for instance_options in self._sensor_instances(name, options):
+                    if instance_options.get("active", False):
+                        sensors.append(self._create_sensor_instance(name, instance_options))
         for pub, sub in sensors:
             logging.info(f"Starting {pub.name}...")
+            if hasattr(pub, "watch"):
+                pub.watch(self._bus_components)
             for mon in self.monitors:
-                pub.subscribe(mon)
+                for topic in mon.topics(pub):
+                    pub.subscribe(mon, topic)
 
             if sub:
-                pub.subscribe(sub)
+                for topic in sub.topics(pub):
+                    pub.subscribe(sub, topic)
                 if not sub.start():
                     logging.error(f"Failed to start {sub.name}")
                     pub.unsubscribe(sub)
@@ -95,24 +139,88 @@ class Recorder:
         for pub, sub in reversed(self.sensors):
             logging.info(f"Stopping {pub.name}...")
             pub.stop()
+            if isinstance(pub, process.ProcessPublisher):
+                self._record_process_stats(pub)
             if sub:
                 pub.unsubscribe(sub)
                 sub.stop()
+                self._record_dropped_messages(sub)
             for mon in reversed(self.monitors):
                 pub.unsubscribe(mon)
             logging.info(f"{pub.name} stopped.")
         self.sensors = []
 
+    def _bus_components(self) -> List[Any]:
+        """Current publishers and subscribers, handed to components that watch() the bus."""
+        components = list(self.monitors)
+        for pub, sub in self.sensors:
+            components += [pub, sub] if sub else [pub]
+        return components
+
+    def _record_dropped_messages(self, sub: base.Subscriber):
+        dropped = sub.dropped_messages
+        if dropped:
+            logging.warning(f"{sub.name} dropped {dropped} messages")
+        stats = self.trip.options.setdefault("stats", {}).setdefault("dropped_messages", {})
+        stats[sub.name] = stats.get(sub.name, 0) + dropped
+
+    def _record_process_stats(self, pub: process.ProcessPublisher):
+        stats = self.trip.options.setdefault("stats", {})
+        dropped = pub.stats.get("dropped_messages", 0)
+        if dropped:
+            logging.warning(f"{pub.name} dropped {dropped} messages")
+        dropped_stats = stats.setdefault("dropped_messages", {})
+        dropped_stats[pub.name] = dropped_stats.get(pub.name, 0) + dropped
+        if "diskwriter" in pub.stats:
+            stats.setdefault("process_diskwriter", {})[pub.name] = pub.stats["diskwriter"]
+
     def _create_monitor_instance(self, name: str, options: Dict[str, Any]) -> base.Subscriber:
         logging.info(f"Loading {name}...")
         options = utils.dict_merge(options.copy(), { "out_dir": self.trip.directory })
         module = importlib.import_module(f"calchas.monitors.{name}")
-        return module.Monitor(options)
+        mon = module.Monitor(options)
+        mon.writer = self.writer
+        mon.runtime = self.runtime
+        return mon
+
+    @staticmethod
+    def _sensor_instances(name: str, options: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Options of every instance of a sensor module.
+
+        Each entry of "instances" overrides the module options for one instance
+        (e.g. another device), named "<module><index>" unless it sets a name.
+        "{index}" in output file names is replaced by the instance index.
+        """
+        instances = options.get("instances") or []
+        result = []
+        for index, overrides in enumerate(instances or [{}]):
+            instance_options = {k: copy.deepcopy(v) for k, v in options.items() if k != "instances"}
+            instance_options = utils.dict_merge(instance_options, copy.deepcopy(overrides))
+            if instances and "name" not in overrides:
+                instance_options["name"] = f"{name}{index}"
+            instance_options["module"] = name
+            instance_options["index"] = index
+            for key, value in instance_options.items():
+                if key.startswith("output_") and isinstance(value, str):
+                    # Only the placeholder; other braces are part of the file name.
+                    instance_options[key] = value.replace("{index}", str(index))
+            result.append(instance_options)
+        return result
 
     def _create_sensor_instance(self, name: str, options: Dict[str, Any]) -> Tuple[base.Publisher, base.Subscriber]:
-        logging.info(f"Loading {name}...")
+        logging.info(f"Loading {options['name']} ({name})...")
         options = utils.dict_merge(options.copy(), { "out_dir": self.trip.directory })
+        if options.get("process", False):
+            # Sensor and output run in a child process with their own disk writer.
+            writer_options = self.trip.options.get("diskwriter", {})
+            pub = process.ProcessPublisher(f"calchas.sensors.{name}", options, writer_options if writer_options.get("active", False) else None)
+            return pub, None
+
         module = importlib.import_module(f"calchas.sensors.{name}")
         pub = module.Sensor(options)
+        pub.writer = self.writer
+        pub.runtime = self.runtime
         sub = module.Output(options) if options.get("dry-run", False) is False else None
+        if sub:
+            sub.writer = self.writer
         return pub, sub
@@ -1,45 +1,110 @@
+import asyncio
 import csv
 import datetime
+import io
 import logging
 import os
+import struct
+import sys
 import threading
 import time
-from typing import Any, Dict, List
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
 import pynmea2
 import serial
 
-from calchas.common import base
+from calchas.common import base, diskwriter, recfile
 
 
 class NMEAByteStream:
-    def __init__(self, stream):
-        self.stream = stream
+    """Frames NMEA sentences from a serial port or any other byte stream.
 
-    def readline(self):
-        while True:
-            try:
-                begin = self._read_to_begin()
-                rest = self._read_until_end()
-                return (begin + rest).decode("ascii")
-            except UnicodeDecodeError as ex:
-                logging.warning(f"Failed reading from byte stream: {ex}. Retrying...")
-
-    def _read_to_begin(self):
-        while True:
-            c = self.stream.read(1)
-            if c in (b'$', b'!'): return c
+    Each read takes whatever the port has buffered, sentences are split with
+    bytes.find and those with an invalid checksum are dropped.
+    """
+    MAX_SENTENCE_LENGTH = 100  # NMEA allows 82 characters; leave room for vendor sentences
 
-    def _read_until_end(self):
-        line = bytearray()
+    def __init__(self, stream, read_size: int=4096):
+        self.stream = stream
+        self.read_size = read_size
+        self.buffer = bytearray()
+        self.invalid_sentences = 0
+
+    def readline(self) -> str:
+        # Interface used by pynmea2.NMEAStreamReader. Returns an empty string
+        # when the stream timed out so callers never block indefinitely.
+        return "".join(f"{s}\r\n" for s in self.read_sentences())
+
+    def read_sentences(self) -> List[str]:
+        """Read the buffered bytes (or wait for one) and return the complete sentences."""
+        waiting = getattr(self.stream, "in_waiting", None)
+        if waiting is None:
+            data = self.stream.read(self.read_size)  # Plain files, e.g. a replayed capture
+        else:
+            data = self.stream.read(max(1, waiting))
+        return self.feed(data) if data else []
+
+    def feed(self, data: bytes) -> List[str]:
+        if b"\x00" in data:
+            data = data.replace(b"\x00", b"")
+        buf = self.buffer
+        buf += data
+
+        sentences = []
+        pos = 0
         while True:
-            c = self.stream.read(1)
-            if c == b'\x00': continue
-            if not c: break
-            line += c
-            if line[-2:] == b'\r\n': break
-            if len(line) >= 81: break
-        return bytes(line)
+            start = self._find_start(buf, pos)
+            if start < 0:
+                pos = len(buf)
+                break
+            end = buf.find(b"\n", start)
+            if end < 0:
+                # Incomplete; keep it unless it cannot be a sentence anymore.
+                pos = start if len(buf) - start <= self.MAX_SENTENCE_LENGTH else start + 1
+                if pos == start:
+                    break
+                continue
+
+            sentence = bytes(buf[start:end]).rstrip(b"\r")
+            # A sentence cut off by a new start character is only a fragment.
+            restart = self._find_start(sentence, 1)
+            if restart > 0:
+                self.invalid_sentences += 1
+                pos = start + restart
+                continue
+
+            pos = end + 1
+            if self.is_valid(sentence):
+                sentences.append(sentence.decode("ascii"))
+            else:
+                self.invalid_sentences += 1
+
+        del buf[:pos]
+        return sentences
+
+    @staticmethod
+    def _find_start(buf, pos: int) -> int:
+        dollar = buf.find(b"$", pos)
+        bang = buf.find(b"!", pos)
+        if dollar < 0 or bang < 0:
+            return max(dollar, bang)
+        return min(dollar, bang)
+
+    @staticmethod
+    def is_valid(sentence: bytes) -> bool:
+        if len(sentence) > NMEAByteStream.MAX_SENTENCE_LENGTH or not sentence.isascii():
+            return False
+        star = sentence.rfind(b"*")
+        if star < 0:
+            return True  # The checksum is optional
+        try:
+            expected = int(sentence[star + 1:star + 3], 16)
+        except ValueError:
+            return False
+        checksum = 0
+        for c in sentence[1:star]:
+            checksum ^= c
+        return checksum == expected
 
 
 class NMEAByteStreamReader(pynmea2.NMEAStreamReader):
@@ -53,6 +118,140 @@ NEO_GPS_SAMPLE_RATE_CONFIGS = {
     "10Hz": [0xB5,0x62,0x06,0x08,0x06,0x00,0x64,0x00,0x01,0x00,0x01,0x00,0x7A,0x12,],
 }
 
+UBX_SYNC = b"\xb5\x62"
+UBX_CFG_MSG = (0x06, 0x01)
+UBX_NAV_PVT = (0x01, 0x07)
+
+# Standard NMEA messages (class 0xF0): GGA, GLL, GSA, GSV, RMC, VTG
+NMEA_STANDARD_MESSAGE_IDS = [0x00, 0x01, 0x02, 0x03, 0x04, 0x05]
+
+# Sentence types offered as topics in NMEA mode.
+NMEA_SENTENCE_TOPICS = ("GGA", "RMC", "VTG", "GSA", "GSV")
+
+
+def _ubx_checksum(data: bytes) -> bytes:
+    ck_a = ck_b = 0
+    for c in data:
+        ck_a = (ck_a + c) & 0xff
+        ck_b = (ck_b + ck_a) & 0xff
+    return bytes((ck_a, ck_b))
+
+
+def ubx_message(msg_class: int, msg_id: int, payload: bytes=b"") -> bytes:
+    body = struct.pack("<BBH", msg_class, msg_id, len(payload)) + payload
+    return UBX_SYNC + body + _ubx_checksum(body)
+
+
+def ubx_set_message_rate(msg_class: int, msg_id: int, rate: int) -> bytes:
+    """CFG-MSG: output the message every `rate` navigation solutions on the current port (0 disables it)."""
+    return ubx_message(*UBX_CFG_MSG, bytes((msg_class, msg_id, rate)))
+
+
+class UBXByteStream:
+    """Frames UBX messages from a serial port; the counterpart of NMEAByteStream."""
+    MAX_PAYLOAD_LENGTH = 1024
+
+    def __init__(self, stream, read_size: int=4096):
+        self.stream = stream
+        self.read_size = read_size
+        self.buffer = bytearray()
+        self.invalid_messages = 0
+
+    def read_messages(self) -> List[Tuple[int, int, bytes]]:
+        waiting = getattr(self.stream, "in_waiting", None)
+        if waiting is None:
+            data = self.stream.read(self.read_size)
+        else:
+            data = self.stream.read(max(1, waiting))
+        return self.feed(data) if data else []
+
+    def feed(self, data: bytes) -> List[Tuple[int, int, bytes]]:
+        """Return (class, id, payload) of every complete message with a valid checksum."""
+        buf = self.buffer
+        buf += data
+
+        messages = []
+        pos = 0
+        while True:
+            start = buf.find(UBX_SYNC, pos)
+            if start < 0:
+                # Keep a trailing sync byte, the rest is NMEA or noise.
+                pos = len(buf) - 1 if buf.endswith(UBX_SYNC[:1]) else len(buf)
+                break
+            if len(buf) - start < 6:
+                pos = start
+                break
+            msg_class, msg_id, length = struct.unpack_from("<BBH", buf, start + 2)
+            if length > self.MAX_PAYLOAD_LENGTH:
+                self.invalid_messages += 1
+                pos = start + 2
+                continue
+            end = start + 6 + length + 2
+            if end > len(buf):
+                pos = start
+                break
+
+            if _ubx_checksum(buf[start + 2:end - 2]) == buf[end - 2:end]:
+                messages.append((msg_class, msg_id, bytes(buf[start + 6:end - 2])))
+                pos = end
+            else:
+                self.invalid_messages += 1
+                pos = start + 2
+
+        del buf[:pos]
+        return messages
+
+
+class NavPvt(NamedTuple):
+    """Position, velocity and time solution from one UBX-NAV-PVT message."""
+    gps_time: Optional[float]  # UTC epoch seconds, None until date and time are valid
+    fix_type: int  # 0: no fix, 2: 2D, 3: 3D, ...
+    num_sv: int
+    longitude: float  # degrees
+    latitude: float  # degrees
+    altitude: float  # height above mean sea level in meters
+    ground_speed: float  # m/s
+    heading: float  # degrees
+    h_acc: float  # meters
+    s_acc: float  # m/s
+    pdop: float
+
+    # Fields common to u-blox 7 (84 byte payload) and later (92 bytes).
+    _FORMAT = struct.Struct("<IHBBBBBBIiBBBBiiiiIIiiiiiIIH")
+    MIN_PAYLOAD_LENGTH = 84
+
+    @classmethod
+    def decode(cls, payload: bytes) -> Optional["NavPvt"]:
+        """None if the payload is too short for a NAV-PVT message."""
+        if len(payload) < cls.MIN_PAYLOAD_LENGTH:
+            return None
+        (_itow, year, month, day, hour, minute, sec, valid, _t_acc, nano, fix_type, _flags, _reserved, num_sv,
+         lon, lat, _height, h_msl, h_acc, _v_acc, _vel_n, _vel_e, _vel_d, g_speed, heading, s_acc, _head_acc,
+         pdop) = cls._FORMAT.unpack_from(payload)
+
+        gps_time = None
+        if valid & 0x03 == 0x03:  # validDate and validTime
+            try:
+                # Seconds are added separately, a leap second reads as sec=60.
+                gps_time = (datetime.datetime(year, month, day, hour, minute, tzinfo=datetime.timezone.utc)
+                            + datetime.timedelta(seconds=sec)).timestamp() + nano * 1e-9
+            except ValueError:
+                pass  # Out of range despite the valid flags
+
+        return cls(
+            gps_time=gps_time,
+            fix_type=fix_type,
+            num_sv=num_sv,
+            longitude=lon * 1e-7,
+            latitude=lat * 1e-7,
+            altitude=h_msl / 1000.,
+            ground_speed=g_speed / 1000.,
+            heading=heading * 1e-5,
+            h_acc=h_acc / 1000.,
+            s_acc=s_acc / 1000.,
+            pdop=pdop * .01,
+        )
+
 
 class Sensor(base.Publisher):
     def __init__(self, options: Dict[str, Any]):
@@ -60,61 +259,162 @@ class Sensor(base.Publisher):
 
         self.serial = None
         self.read_thread = None
+        self.read_task = None
         self.request_stop = False
 
+    @property
+    def ubx_mode(self) -> bool:
+        return self.options.get("protocol", "nmea") == "ubx"
+
     def offer(self) -> List[str]:
-        # TODO: support topics, e.g. NMEA message types
-        return ["all"]
+        # One topic per NMEA sentence type, or the NAV-PVT solution in UBX mode.
+        return ["PVT"] if self.ubx_mode else list(NMEA_SENTENCE_TOPICS)
 
     def _start_impl(self):
         if not self.serial:
+            rate = self.options.get("rate", "5Hz")
+            if rate not in NEO_GPS_SAMPLE_RATE_CONFIGS:
+                raise ValueError(f"Unsupported GPS rate {rate}, use one of {list(NEO_GPS_SAMPLE_RATE_CONFIGS)}")
+
             self.serial = serial.Serial(self.options["serial_dev"], baudrate=self.options["serial_baudrate"], timeout=self.options["serial_timeout"])
+            self.serial.write(bytes(NEO_GPS_SAMPLE_RATE_CONFIGS[rate]))
 
-            # TODO: make this configurable through trip options.
-            self.serial.write(bytes(NEO_GPS_SAMPLE_RATE_CONFIGS["5Hz"]))
+            # Switch between NAV-PVT and the NMEA sentences. The receiver keeps
+            # this until power loss, so always configure both directions.
+            self.serial.write(ubx_set_message_rate(*UBX_NAV_PVT, 1 if self.ubx_mode else 0))
+            for msg_id in NMEA_STANDARD_MESSAGE_IDS:
+                self.serial.write(ubx_set_message_rate(0xf0, msg_id, 0 if self.ubx_mode else 1))
 
         self.request_stop = False
-        if not self.read_thread:
+        if self.runtime:
+            if not self.read_task:
+                self.read_task = self.runtime.spawn(self._read_async())
+                logging.info(f"GPS reader started on the event loop.")
+        elif not self.read_thread:
             logging.info("Starting GPS thread...")
-            self.read_thread = threading.Thread(target=self._read_thread_fn)
+            self.read_thread = threading.Thread(target=self._read_thread_fn, name=self.name)
             self.read_thread.start()
             logging.info(f"GPS thread started.")
 
     def _stop_impl(self):
         self.request_stop = True
+        if self.read_task:
+            self.runtime.cancel(self.read_task)
+            self.read_task = None
         if self.read_thread:
             self.read_thread.join()
             self.read_thread = None
 
-    def _read_thread_fn(self):
-        if self.request_stop:
+    def _create_stream(self):
+        return UBXByteStream(self.serial) if self.ubx_mode else NMEAByteStream(self.serial)
+
+    def _process(self, stream, data: bytes=None) -> None:
+        # Reads from the port itself if no data is given; empty when the serial read timed out.
+        if self.ubx_mode:
+            for msg_class, msg_id, payload in (stream.read_messages() if data is None else stream.feed(data)):
+                if (msg_class, msg_id) == UBX_NAV_PVT:
+                    pvt = NavPvt.decode(payload)
+                    if pvt is None:
+                        logging.debug(f"Ignoring NAV-PVT message with {len(payload)} byte payload")
+                        continue
+                    self.publish("PVT", pvt)
             return
 
-        for batch in NMEAByteStreamReader(self.serial):
-            if self.request_stop:
-                return
+        for sentence in (stream.read_sentences() if data is None else stream.feed(data)):
+            # "$GPGGA,..." -> "GGA". Only parse what somebody subscribed to.
+            sentence_type = sentence[3:6]
+            if not self.has_subscribers(sentence_type):
+                continue
+            try:
+                msg = pynmea2.parse(sentence)
+            except pynmea2.ParseError as ex:
+                logging.debug(f"Failed parsing NMEA sentence: {ex}")
+                continue
 
-            # FIXME: when there's no GPS connected, this will block indefinitely
-            for msg in batch:
-                if isinstance(msg, pynmea2.GGA):
-                    # TODO: create classes for payload-types
-                    self.publish("all", msg)
+            self.publish(sentence_type, msg)
 
-            if self.request_stop:
-                return
+    def _read_thread_fn(self):
+        stream = self._create_stream()
+        while not self.request_stop:
+            self._process(stream)
+
+    async def _read_async(self):
+        # Wait for the port to become readable and take whatever it buffered
+        # from the non-blocking descriptor, so the event loop never blocks on
+        # a silent receiver.
+        loop = asyncio.get_running_loop()
+        stream = self._create_stream()
+        readable = asyncio.Event()
+        try:
+            fd = self.serial.fileno()
+            blocking = os.get_blocking(fd)
+            os.set_blocking(fd, False)
+            loop.add_reader(fd, readable.set)
+        except (AttributeError, NotImplementedError, OSError):
+            # No pollable descriptor (e.g. Windows): fall back to the blocking reads on the executor.
+            logging.info("GPS port cannot be polled, reading on the executor")
+            while not self.request_stop:
+                await loop.run_in_executor(None, self._process, stream)
+            return
+
+        try:
+            while not self.request_stop:
+                await readable.wait()
+                readable.clear()
+                try:
+                    data = os.read(fd, stream.read_size)
+                except BlockingIOError:
+                    continue
+                if data:
+                    self._process(stream, data)
+        finally:
+            loop.remove_reader(fd)
+            os.set_blocking(fd, blocking)
 
 
 class Output(base.Subscriber):
     def __init__(self, options: Dict[str, Any]):
         super().__init__(options)
 
-        self.fpath = os.path.join(self.out_dir, self.options["output"])
+        self.binary = self.options.get("output_format", "csv") == "binary"
+        self.fpath = os.path.join(self.out_dir, self.options["output_binary" if self.binary else "output"])
         self.fd = None
         self.header_written = False
+        self.rec_writer = None
         self.data = []
 
+        self.ubx_mode = self.options.get("protocol", "nmea") == "ubx"
+        self.sentences = ["GGA"] + [t for t in self.options.get("output_sentences", []) if t != "GGA"]
+        self.latest = {}
+        self.fields = [
+            ("timestamp", "d"),
+            ("longitude", "d"),
+            ("latitude", "d"),
+            ("altitude", "f"),
+        ]
+        if not self.ubx_mode:
+            # Rows are written per GGA fix, together with the latest values
+            # from the other requested sentence types.
+            if "RMC" in self.sentences or "VTG" in self.sentences:
+                self.fields += [("ground_speed", "f")]
+            if "GSA" in self.sentences:
+                self.fields += [("pdop", "f"), ("hdop", "f"), ("vdop", "f")]
+            if "GSV" in self.sentences:
+                self.fields += [("satellites_in_view", "B")]
+        else:
+            self.fields += [
+                ("ground_speed", "f"),
+                ("heading", "f"),
+                ("fix_type", "B"),
+                ("num_sv", "B"),
+                ("pdop", "f"),
+                ("gps_time", "d"),
+            ]
+
     def _start_impl(self):
-        self.fd = open(self.fpath, "w", newline="")
+        self.fd = diskwriter.open_file(self.writer, self.fpath)
+        if self.binary:
+            self.rec_writer = recfile.RecordWriter(self.fd, self.fields)
         self.header_written = False
         self.data = []
 
@@ -124,25 +424,109 @@ class Output(base.Subscriber):
         if self.fd:
             self.fd.close()
             self.fd = None
+            self.rec_writer = None
+
+    def topics(self, publisher: base.Publisher) -> List[str]:
+        return publisher.offer() if self.ubx_mode else self.sentences
 
     def on_process_message(self, msg: base.Message):
-        self.data.append([
-            msg.timestamp,
-            msg.data.longitude or 0.0,
-            msg.data.latitude or 0.0,
-            msg.data.altitude or 0.0,
-        ])
+        self.on_process_batch([msg])
+
+    def on_process_batch(self, messages: List[base.Message]):
+        if self.ubx_mode:
+            columns = [(name, t in "fd") for name, t in self.fields[1:]]
+            for msg in messages:
+                self.data.append([msg.timestamp] + [
+                    (getattr(msg.data, name) or 0.0) if is_float else getattr(msg.data, name)
+                    for name, is_float in columns
+                ])
+        else:
+            for msg in messages:
+                self._process_sentence(msg)
 
         # Write data to disk every X entries
-        if len(self.data) % self.options["output_write_threshold"] == 0:
+        if len(self.data) >= self.options["output_write_threshold"]:
             self.flush()
 
+    def _process_sentence(self, msg: base.Message):
+        def to_float(value) -> float:
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                return 0.0
+
+        if msg.topic == "GGA":
+            self.data.append([
+                msg.timestamp,
+                msg.data.longitude or 0.0,
+                msg.data.latitude or 0.0,
+                msg.data.altitude or 0.0,
+            ] + [self.latest.get(name, 0) for name, _ in self.fields[4:]])
+        elif msg.topic == "RMC":
+            self.latest["ground_speed"] = to_float(msg.data.spd_over_grnd) * 0.514444  # knots
+        elif msg.topic == "VTG":
+            self.latest["ground_speed"] = to_float(msg.data.spd_over_grnd_kmph) / 3.6
+        elif msg.topic == "GSA":
+            self.latest["pdop"] = to_float(msg.data.pdop)
+            self.latest["hdop"] = to_float(msg.data.hdop)
+            self.latest["vdop"] = to_float(msg.data.vdop)
+        elif msg.topic == "GSV":
+            self.latest["satellites_in_view"] = int(to_float(msg.data.num_sv_in_view))
+
     def flush(self):
-        if self.fd and (self.data or not self.header_written):
-            writer = csv.writer(self.fd)
+        if self.rec_writer:
+            self.rec_writer.write_rows(self.data)
+        elif self.fd and (self.data or not self.header_written):
+            buf = io.StringIO()
+            writer = csv.writer(buf)
             if not self.header_written:
-                writer.writerow(["timestamp", "longitude", "latitude", "altitude"])
+                writer.writerow([name for name, _ in self.fields])
                 self.header_written = True
             writer.writerows(self.data)
+            self.fd.write(buf.getvalue().encode("utf-8"))
         self.data.clear()
         logging.info("GPS output flushed")
+
+
+def main():
+    """Benchmark NMEA framing by replaying a recorded capture.
+
+    Usage: python -m calchas.sensors.gps capture.nmea [repeat]
+    """
+    class ByteLoopStream:
+        """The previous framing: one read(1) per character."""
+        def __init__(self, stream):
+            self.stream = stream
+
+        def read_sentences(self):
+            while True:
+                c = self.stream.read(1)
+                if not c:
+                    return []
+                if c in (b'$', b'!'):
+                    break
+            line = bytearray(c)
+            while True:
+                c = self.stream.read(1)
+                if c == b'\x00': continue
+                if not c: break
+                line += c
+                if line[-2:] == b'\r\n': break
+                if len(line) >= 82: break
+            return [bytes(line).decode("ascii", errors="replace").rstrip()]
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
+    with open(sys.argv[1], "rb") as f:
+        capture = f.read() * (int(sys.argv[2]) if len(sys.argv) > 2 else 1)
+
+    for name, stream in (("byte loop", ByteLoopStream(io.BytesIO(capture))), ("chunked", NMEAByteStream(io.BytesIO(capture)))):
+        count = 0
+        begin = time.perf_counter()
+        while stream.stream.tell() < len(capture):
+            count += len(stream.read_sentences())
+        elapsed = time.perf_counter() - begin
+        print(f"{name}: {count} sentences in {elapsed:.3f}s ({count / elapsed:.0f} sentences/s, {len(capture) / elapsed / 1e6:.2f}MB/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,164 @@
 import csv
+import ctypes
 import datetime
+import io
 import logging
 import math
 import os
-import threading
+import struct
+import sys
 import time
 from typing import Any, Dict, List
 
 import smbus2
 
-from calchas.common import base
+from calchas.common import base, diskwriter, recfile, runtime
+
+
+# MPU6050 registers
+SMPLRT_DIV = 0x19
+CONFIG = 0x1a
+FIFO_EN = 0x23
+INT_STATUS = 0x3a
+ACCEL_XOUT_H = 0x3b
+USER_CTRL = 0x6a
+FIFO_COUNTH = 0x72
+FIFO_R_W = 0x74
+
+FIFO_EN_ACCEL_GYRO = 0x78  # XG, YG, ZG and ACCEL
+USER_CTRL_FIFO_EN = 0x40
+USER_CTRL_FIFO_RESET = 0x04
+INT_STATUS_FIFO_OFLOW = 0x10
+FIFO_SIZE = 1024
+
+# Accel, temperature and gyro registers (0x3b-0x48) as big-endian int16.
+_SAMPLE_BLOCK = struct.Struct(">7h")
+# One FIFO sample with FIFO_EN_ACCEL_GYRO: accel xyz, gyro xyz (register order).
+_FIFO_SAMPLE = struct.Struct(">6h")
+
+# Gyro output rate with the digital low-pass filter enabled.
+GYRO_OUTPUT_RATE_HZ = 1000
+MAX_FREQUENCY_HZ = 1000
+
+
+def _dist(a, b):
+    return math.sqrt((a * a) + (b * b))
+
+
+def decode_sample(block) -> Dict[str, float]:
+    """Convert the 14-byte register block starting at ACCEL_XOUT_H into a sample."""
+    acc_x, acc_y, acc_z, _temp, gyro_x, gyro_y, gyro_z = _SAMPLE_BLOCK.unpack(bytes(block))
+    return _to_sample(acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z)
+
+
+def decode_fifo(data: bytes, first_timestamp: float, period_sec: float) -> List[Dict[str, float]]:
+    """Convert FIFO contents into timestamped samples spaced period_sec apart."""
+    samples = []
+    for i, (acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z) in enumerate(_FIFO_SAMPLE.iter_unpack(data)):
+        sample = {"timestamp": first_timestamp + i * period_sec}
+        sample.update(_to_sample(acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z))
+        samples.append(sample)
+    return samples
+
+
+def _to_sample(acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z) -> Dict[str, float]:
+    acc_x /= 16384.
+    acc_y /= 16384.
+    acc_z /= 16384.
+
+    return {
+        "gyro_x": gyro_x / 131.,
+        "gyro_y": gyro_y / 131.,
+        "gyro_z": gyro_z / 131.,
+        "acc_x": acc_x,
+        "acc_y": acc_y,
+        "acc_z": acc_z,
+        "rot_x": math.degrees(math.atan2(acc_x, _dist(acc_y, acc_z))),
+        "rot_y": -math.degrees(math.atan2(acc_y, _dist(acc_x, acc_z))),
+    }
+
+
+class FakeSMBus:
+    """Stand-in for smbus2.SMBus that simulates an MPU6050 off-device.
+
+    Produces slowly changing accel/gyro values, fills the FIFO at the configured
+    sample rate and optionally sleeps for transaction_sec per I2C transaction to
+    model bus time.
+    """
+    def __init__(self, bus: Any=None, transaction_sec: float=0.):
+        self.transaction_sec = transaction_sec
+        self.transactions = 0
+        self.registers = bytearray(256)
+        self.fifo = bytearray()
+        self._fifo_time = time.time()
+
+    def close(self):
+        pass
+
+    def write_byte_data(self, i2c_addr: int, register: int, value: int):
+        self._transaction()
+        self._update_fifo()
+        if register == USER_CTRL and value & USER_CTRL_FIFO_RESET:
+            self.fifo.clear()
+            self._fifo_time = time.time()
+            value &= ~USER_CTRL_FIFO_RESET
+        self.registers[register] = value & 0xff
+
+    def read_byte_data(self, i2c_addr: int, register: int) -> int:
+        return self.read_i2c_block_data(i2c_addr, register, 1)[0]
+
+    def read_i2c_block_data(self, i2c_addr: int, register: int, length: int) -> List[int]:
+        self._transaction()
+        return list(self._read(register, length))
+
+    def i2c_rdwr(self, *i2c_msgs):
+        self._transaction()
+        register = 0
+        for msg in i2c_msgs:
+            if msg.flags & smbus2.smbus2.I2C_M_RD:
+                data = self._read(register, msg.len)
+                ctypes.memmove(msg.buf, data, len(data))
+            else:
+                register = bytes(msg)[0]
+
+    def _read(self, register: int, length: int) -> bytes:
+        self._update_fifo()
+        if register == FIFO_R_W:
+            data = bytes(self.fifo[:length])
+            del self.fifo[:length]
+            return data.ljust(length, b"\x00")
+
+        _SAMPLE_BLOCK.pack_into(self.registers, ACCEL_XOUT_H, *self._sample(time.time()))
+        struct.pack_into(">H", self.registers, FIFO_COUNTH, len(self.fifo))
+        data = bytes(self.registers[register:register + length])
+        if register <= INT_STATUS < register + length:
+            self.registers[INT_STATUS] = 0  # Cleared on read
+        return data
+
+    def _transaction(self):
+        self.transactions += 1
+        if self.transaction_sec > 0:
+            time.sleep(self.transaction_sec)
+
+    def _sample(self, t: float):
+        return (int(1638 * math.sin(t)), int(1638 * math.cos(t)), 16384,
+                0,
+                int(1310 * math.sin(3 * t)), 0, int(-1310 * math.cos(3 * t)))
+
+    def _update_fifo(self):
+        now = time.time()
+        if not (self.registers[USER_CTRL] & USER_CTRL_FIFO_EN and self.registers[FIFO_EN]):
+            self._fifo_time = now
+            return
+
+        period_sec = (1 + self.registers[SMPLRT_DIV]) / GYRO_OUTPUT_RATE_HZ
+        while self._fifo_time + period_sec <= now:
+            self._fifo_time += period_sec
+            acc_x, acc_y, acc_z, _temp, gyro_x, gyro_y, gyro_z = self._sample(self._fifo_time)
+            self.fifo += _FIFO_SAMPLE.pack(acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z)
+        if len(self.fifo) > FIFO_SIZE:
+            del self.fifo[:len(self.fifo) - FIFO_SIZE]
+            self.registers[INT_STATUS] |= INT_STATUS_FIFO_OFLOW
 
 
 class Sensor(base.Publisher):
@@ -17,84 +166,150 @@ class Sensor(base.Publisher):
         super().__init__(options)
 
         self.impl = None
-        self.read_thread = None
+        self.frequency = None  # Requested rate, limited to what the sensor supports
+        self.sample_rate = None
+        self.worker = None
         self.request_stop = False
 
+    @property
+    def fifo_mode(self) -> bool:
+        return self.options.get("mode", "poll") == "fifo"
+
     def offer(self) -> List[str]:
         # TODO: support topics, e.g. gyro, acc, rot
-        return ["all"]
+        # In FIFO mode, samples are published in batches of timestamped dicts.
+        return ["batch"] if self.fifo_mode else ["all"]
 
     def _start_impl(self):
+        self.frequency = self.options.get("frequency", 1.)
+        if self.frequency > MAX_FREQUENCY_HZ:
+            logging.warning(f"IMU frequency {self.frequency}Hz not supported, using {MAX_FREQUENCY_HZ}Hz")
+            self.frequency = MAX_FREQUENCY_HZ
+
         if not self.impl:
-            self.impl = smbus2.SMBus(self.options["i2c_bus"])
-            self.impl.write_byte_data(self.options["address"], self.options["power_mgmt_1"], 0)
+            if self.options["i2c_bus"] == "fake":
+                self.impl = FakeSMBus(transaction_sec=self.options.get("fake_transaction_sec", 0.))
+            else:
+                self.impl = smbus2.SMBus(self.options["i2c_bus"])
+            address = self.options["address"]
+            self.impl.write_byte_data(address, self.options["power_mgmt_1"], 0)
+
+            # Let the sensor update its output registers at the requested rate:
+            # sample rate = gyro output rate / (1 + SMPLRT_DIV).
+            self.impl.write_byte_data(address, CONFIG, self.options.get("dlpf_cfg", 1))
+            divider = min(255, max(0, int(round(GYRO_OUTPUT_RATE_HZ / self.frequency)) - 1))
+            self.impl.write_byte_data(address, SMPLRT_DIV, divider)
+            self.sample_rate = GYRO_OUTPUT_RATE_HZ / (1 + divider)
+
+            if self.fifo_mode:
+                self.impl.write_byte_data(address, FIFO_EN, FIFO_EN_ACCEL_GYRO)
+                self.impl.write_byte_data(address, USER_CTRL, USER_CTRL_FIFO_EN | USER_CTRL_FIFO_RESET)
 
         self.request_stop = False
-        if not self.read_thread:
-            logging.info("Starting IMU thread...")
-            self.read_thread = threading.Thread(target=self._read_thread_fn)
-            self.read_thread.start()
-            logging.info(f"IMU thread started.")
+        if not self.worker:
+            logging.info("Starting IMU loop...")
+            self.worker = runtime.Worker(self.name, self._read_fifo_steps if self.fifo_mode else self._read_steps, self.runtime)
+            self.worker.start()
+            logging.info(f"IMU loop started.")
 
     def _stop_impl(self):
         self.request_stop = True
-        if self.read_thread:
-            self.read_thread.join()
-            self.read_thread = None
-
-    def _read_thread_fn(self):
-        def read_word(bus, address, reg):
-            h = bus.read_byte_data(address, reg)
-            l = bus.read_byte_data(address, reg + 1)
-            val = (h << 8) + l
-            return -((65535 - val) + 1) if (val >= 0x8000) else val
+        if self.worker:
+            self.worker.stop()
+            self.worker = None
 
-        def dist(a, b):
-            return math.sqrt((a * a) + (b * b))
+        if self.impl:
+            if self.fifo_mode:
+                self.impl.write_byte_data(self.options["address"], USER_CTRL, 0)
+                self.impl.write_byte_data(self.options["address"], FIFO_EN, 0)
+            self.impl.close()
+            self.impl = None
 
+    def _read_steps(self) -> runtime.Steps:
         address = self.options["address"]
-        frequency_sleep_sec = 1. / self.options.get("frequency", 1.)
+        period_sec = 1. / self.frequency
+        next_sample = time.time()
         while not self.request_stop:
-            gyro_x = read_word(self.impl, address, 0x43) / 131.
-            gyro_y = read_word(self.impl, address, 0x45) / 131.
-            gyro_z = read_word(self.impl, address, 0x47) / 131.
-
-            acc_x = read_word(self.impl, address, 0x3b) / 16384.
-            acc_y = read_word(self.impl, address, 0x3d) / 16384.
-            acc_z = read_word(self.impl, address, 0x3f) / 16384.
-
-            rot_x = math.degrees(math.atan2(acc_x, dist(acc_y, acc_z)))
-            rot_y = -math.degrees(math.atan2(acc_y, dist(acc_x, acc_z)))
-
-            data = {
-                "gyro_x": gyro_x,
-                "gyro_y": gyro_y,
-                "gyro_z": gyro_z,
-                "acc_x": acc_x,
-                "acc_y": acc_y,
-                "acc_z": acc_z,
-                "rot_x": rot_x,
-                "rot_y": rot_y,
-            }
+            # One I2C transaction for all accel, temperature and gyro registers.
+            block = self.impl.read_i2c_block_data(address, ACCEL_XOUT_H, _SAMPLE_BLOCK.size)
 
             # TODO: create classes for payload-types
-            self.publish("all", data)
+            self.publish("all", decode_sample(block))
 
-            time.sleep(frequency_sleep_sec - time.time() % frequency_sleep_sec)
+            # Sleep until the next sample is due; skip ahead instead of bursting when late.
+            next_sample += period_sec
+            delay = next_sample - time.time()
+            if delay < -period_sec:
+                next_sample = time.time()
+            yield delay
+
+    def _read_fifo_steps(self) -> runtime.Steps:
+        address = self.options["address"]
+        period_sec = 1. / self.sample_rate
+        sample_size = _FIFO_SAMPLE.size
+        max_read = sample_size * (self.options.get("fifo_read_bytes", 960) // sample_size)
+
+        # The 1KB FIFO fills quickly at high rates (~85ms at 1kHz), so wake up
+        # well before it overflows even if a longer interval is configured.
+        fifo_fill_sec = (FIFO_SIZE // sample_size) * period_sec
+        interval_sec = min(self.options.get("fifo_read_interval", .25), fifo_fill_sec / 2)
+        logging.info(f"IMU FIFO mode at {self.sample_rate:.1f}Hz, draining every {interval_sec * 1000:.0f}ms")
+
+        last_timestamp = None
+        while not self.request_stop:
+            now = time.time()
+            status = self.impl.read_byte_data(address, INT_STATUS)
+            count_h, count_l = self.impl.read_i2c_block_data(address, FIFO_COUNTH, 2)
+            count = (count_h << 8) | count_l
+            if status & INT_STATUS_FIFO_OFLOW or count % sample_size:
+                logging.warning(f"IMU FIFO overflow ({count} bytes). Resetting FIFO.")
+                self.impl.write_byte_data(address, USER_CTRL, USER_CTRL_FIFO_EN | USER_CTRL_FIFO_RESET)
+                last_timestamp = None
+                count = 0
+
+            data = bytearray()
+            while len(data) < count:
+                length = min(max_read, count - len(data))
+                write = smbus2.i2c_msg.write(address, [FIFO_R_W])
+                read = smbus2.i2c_msg.read(address, length)
+                self.impl.i2c_rdwr(write, read)
+                data += bytes(read)
+
+            if data:
+                # The newest sample was taken at most one period before the FIFO count
+                # was read. Continue the previous batch's timeline and only pull it
+                # slowly towards the read time, which absorbs read jitter and the
+                # drift of the sensor clock. Re-anchor if they are too far apart.
+                samples = len(data) // sample_size
+                first_timestamp = now - (samples - 1) * period_sec
+                if last_timestamp is not None:
+                    expected = last_timestamp + period_sec
+                    error = first_timestamp - expected
+                    if abs(error) < interval_sec:
+                        first_timestamp = max(expected + .1 * error, last_timestamp + period_sec / 2)
+                batch = decode_fifo(bytes(data), first_timestamp, period_sec)
+                last_timestamp = batch[-1]["timestamp"]
+
+                self.publish("batch", batch)
+
+            yield interval_sec - (time.time() - now)
 
 
 class Output(base.Subscriber):
     def __init__(self, options: Dict[str, Any]):
         super().__init__(options)
 
-        self.fpath = os.path.join(self.out_dir, self.options["output"])
+        self.binary = self.options.get("output_format", "csv") == "binary"
+        self.fpath = os.path.join(self.out_dir, self.options["output_binary" if self.binary else "output"])
         self.fd = None
         self.header_written = False
+        self.rec_writer = None
         self.data = []
 
     def _start_impl(self):
-        self.fd = open(self.fpath, "w", newline="")
+        self.fd = diskwriter.open_file(self.writer, self.fpath)
         self.header_written = False
+        self.rec_writer = None
         self.data = []
 
     def _stop_impl(self):
@@ -105,20 +320,117 @@ class Output(base.Subscriber):
             self.fd = None
 
     def on_process_message(self, msg: base.Message):
-        new_data = {"timestamp": msg.timestamp}
-        new_data.update(msg.data)
-        self.data.append(new_data)
+        self.on_process_batch([msg])
+
+    def on_process_batch(self, messages: List[base.Message]):
+        for msg in messages:
+            if msg.topic == "batch":
+                # FIFO samples carry their own timestamps.
+                self.data.extend(msg.data)
+                continue
+            new_data = {"timestamp": msg.timestamp}
+            new_data.update(msg.data)
+            self.data.append(new_data)
 
         # Write data to disk every X entries
-        if len(self.data) % self.options["output_write_threshold"] == 0:
+        if len(self.data) >= self.options["output_write_threshold"]:
             self.flush()
 
     def flush(self):
         if self.fd and self.data:
-            writer = csv.DictWriter(self.fd, fieldnames=self.data[0].keys())
-            if not self.header_written:
-                writer.writeheader()
-                self.header_written = True
-            writer.writerows(self.data)
+            if self.binary:
+                if not self.rec_writer:
+                    self.rec_writer = recfile.RecordWriter(self.fd, recfile.fields_from_keys(self.data[0].keys(), "f", {"timestamp": "d"}))
+                names = self.rec_writer.names
+                self.rec_writer.write_rows([[d[k] for k in names] for d in self.data])
+            else:
+                buf = io.StringIO()
+                writer = csv.DictWriter(buf, fieldnames=self.data[0].keys())
+                if not self.header_written:
+                    writer.writeheader()
+                    self.header_written = True
+                writer.writerows(self.data)
+                self.fd.write(buf.getvalue().encode("utf-8"))
         self.data.clear()
         logging.info("IMU output flushed")
+
+
+class _Counter(base.Subscriber):
+    def __init__(self):
+        super().__init__({"name": "counter"})
+        self.timestamps = []
+
+    def on_message(self, msg: base.Message):
+        if msg.topic == "batch":
+            self.timestamps.extend(sample["timestamp"] for sample in msg.data)
+        else:
+            self.timestamps.append(msg.timestamp)
+
+
+def main():
+    """Benchmark the IMU read path off-device on a simulated bus.
+
+    Usage: python -m calchas.sensors.imu [frequency_hz] [i2c_transaction_sec] [duration_sec] [poll|fifo] [threads|asyncio]
+    """
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
+    frequency = float(sys.argv[1]) if len(sys.argv) > 1 else 1000.
+    transaction_sec = float(sys.argv[2]) if len(sys.argv) > 2 else 0.
+    duration_sec = float(sys.argv[3]) if len(sys.argv) > 3 else 3.
+    mode = sys.argv[4] if len(sys.argv) > 4 else "poll"
+    runtime_name = sys.argv[5] if len(sys.argv) > 5 else "threads"
+    address = 0x69
+    samples = 2000
+
+    bus = FakeSMBus(transaction_sec=transaction_sec)
+
+    def read_word(reg):
+        h = bus.read_byte_data(address, reg)
+        l = bus.read_byte_data(address, reg + 1)
+        val = (h << 8) + l
+        return -((65535 - val) + 1) if (val >= 0x8000) else val
+
+    begin = time.perf_counter()
+    for _ in range(samples):
+        [read_word(reg) for reg in (0x43, 0x45, 0x47, 0x3b, 0x3d, 0x3f)]
+    per_register_sec = (time.perf_counter() - begin) / samples
+
+    begin = time.perf_counter()
+    for _ in range(samples):
+        decode_sample(bus.read_i2c_block_data(address, ACCEL_XOUT_H, _SAMPLE_BLOCK.size))
+    burst_sec = (time.perf_counter() - begin) / samples
+
+    print(f"per-register read: {per_register_sec * 1e6:.1f}us/sample (12 transactions)")
+    print(f"burst read+decode: {burst_sec * 1e6:.1f}us/sample (1 transaction)")
+
+    sensor = Sensor({
+        "name": "imu",
+        "mode": mode,
+        "frequency": frequency,
+        "i2c_bus": "fake",
+        "fake_transaction_sec": transaction_sec,
+        "address": address,
+        "power_mgmt_1": 0x6b,
+    })
+    if runtime_name == "asyncio":
+        sensor.runtime = runtime.AsyncRuntime()
+        sensor.runtime.start()
+    counter = _Counter()
+    sensor.subscribe(counter)
+    sensor.start()
+    transactions = sensor.impl.transactions
+    time.sleep(duration_sec)
+    transactions = sensor.impl.transactions - transactions
+    sensor.stop()
+    if sensor.runtime:
+        sensor.runtime.stop()
+    print(f"{transactions / duration_sec:.1f} I2C transactions/s")
+
+    intervals = sorted(b - a for a, b in zip(counter.timestamps, counter.timestamps[1:]))
+    if intervals:
+        rate = len(intervals) / (counter.timestamps[-1] - counter.timestamps[0])
+        p99 = intervals[int(0.99 * (len(intervals) - 1))]
+        print(f"sensor loop ({mode}, {runtime_name}): {rate:.1f}Hz achieved of {frequency}Hz, interval p99={p99 * 1e3:.3f}ms max={intervals[-1] * 1e3:.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
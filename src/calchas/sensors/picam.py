@@ -5,12 +5,135 @@ import logging
 import os
 import threading
 import time
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Tuple
 
 import picamera
 from PIL import Image
 
-from calchas.common import base
+from calchas.common import base, diskwriter, mp4, videoindex
+
+
+# The H264 recording uses the default splitter port, the preview another one.
+VIDEO_SPLITTER_PORT = 1
+PREVIEW_SPLITTER_PORT = 2
+
+
+class Preview:
+    """Captures unencoded YUV420 frames from the preview splitter port on its own thread.
+
+    Frames are published on the "preview" topic as greyscale images taken from
+    the Y plane, at most "preview_framerate" times per second and only if
+    somebody subscribed. The captures use a still encoder, so PiCamera.frame
+    keeps describing the H264 recording.
+    """
+    def __init__(self, sensor: "Sensor", resolution: Tuple[int, int], framerate: float):
+        self.sensor = sensor
+        self.resolution = resolution
+        # YUV frames are padded to a width of 32 and a height of 16 pixels.
+        self.padded_resolution = ((resolution[0] + 31) // 32 * 32, (resolution[1] + 15) // 16 * 16)
+        self.interval_sec = None
+        self.request_stop = False
+        self.thread = None
+        self.set_framerate(framerate)
+
+    def set_framerate(self, framerate: float) -> None:
+        # 0 pauses the preview; no frames are captured meanwhile.
+        self.interval_sec = 1. / framerate if framerate > 0 else None
+
+    def start(self) -> None:
+        self.request_stop = False
+        self.thread = threading.Thread(target=self._capture_thread_fn, name=f"{self.sensor.name}-preview")
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.request_stop = True
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def _capture_thread_fn(self) -> None:
+        stream = io.BytesIO()
+        next_preview = 0.
+        while not self.request_stop:
+            if self.interval_sec is None or time.time() < next_preview or not self.sensor.has_subscribers("preview"):
+                time.sleep(.1)
+                continue
+            next_preview = time.time() + self.interval_sec
+
+            stream.seek(0)
+            stream.truncate()
+            self.sensor.impl.capture(stream, format="yuv", resize=self.resolution, use_video_port=True, splitter_port=PREVIEW_SPLITTER_PORT)
+            image = Image.frombuffer("L", self.padded_resolution, stream.getvalue(), "raw", "L", 0, 1)
+            if self.padded_resolution != self.resolution:
+                image = image.crop((0, 0, *self.resolution))
+            else:
+                image = image.copy()
+            self.sensor.publish("preview", image)
+
+
+def data_path(options: Dict[str, Any]) -> str:
+    container = options.get("output_container", "h264")
+    return os.path.join(options["out_dir"], options["output_mp4"] if container == "mp4" else options["output_data"])
+
+
+class VideoFile:
+    """The H264 stream of a recording, written as is or muxed into fragmented MP4.
+
+    A raw stream gets a keyframe index if an index file is given.
+    """
+    def __init__(self, fd, options: Dict[str, Any], index_fd=None):
+        self.fd = fd
+        self.muxer = None
+        if options.get("output_container", "h264") == "mp4":
+            self.muxer = mp4.FragmentedMP4Writer(fd, options["width"], options["height"],
+                fragment_duration=options.get("output_fragment_sec", 1.))
+        self.index = videoindex.IndexWriter(index_fd) if index_fd else None
+        self.offset = 0
+        self.frame_num = 0
+        self.frame_start = True
+        self.last_frame_type = None
+        self.chunks = []
+        self.timestamp = None
+
+    def write(self, data: bytes, frame: picamera.PiVideoFrame, timestamp: float) -> None:
+        if not self.muxer:
+            if self.index and self.frame_start:
+                self._index_frame(frame, timestamp)
+            self.fd.write(data)
+            self.offset += len(data)
+            if frame.complete:
+                self.frame_num += 1
+                self.last_frame_type = frame.frame_type
+            self.frame_start = frame.complete
+            return
+
+        # A frame may arrive in several chunks; it is timed by its first one like in picam.csv.
+        if not self.chunks:
+            self.timestamp = timestamp
+        self.chunks.append(data)
+        if frame.complete:
+            self.muxer.write_frame(self.chunks[0] if len(self.chunks) == 1 else b"".join(self.chunks), self.timestamp)
+            self.chunks.clear()
+
+    def close(self) -> None:
+        if self.muxer:
+            self.muxer.close()
+        if self.index:
+            self.index.close()
+        self.fd.close()
+
+    def _index_frame(self, frame: picamera.PiVideoFrame, timestamp: float) -> None:
+        # Decoding can start at an SPS header, or at a keyframe the encoder sent without one.
+        if frame.frame_type == picamera.PiVideoFrameType.sps_header or \
+           (frame.frame_type == picamera.PiVideoFrameType.key_frame and self.last_frame_type != picamera.PiVideoFrameType.sps_header):
+            self.index.add(timestamp, self.offset, self.frame_num, frame.frame_type)
+
+
+def open_video_file(writer: diskwriter.DiskWriter, options: Dict[str, Any]) -> VideoFile:
+    index_fd = None
+    if options.get("output_container", "h264") == "h264" and options.get("output_index"):
+        index_fd = diskwriter.open_file(writer, os.path.join(options["out_dir"], options["output_index"]))
+    return VideoFile(diskwriter.open_file(writer, data_path(options)), options, index_fd)
 
 
 class Sensor(base.Publisher):
@@ -18,14 +141,18 @@ class Sensor(base.Publisher):
         super().__init__(options)
 
         self.impl = None
+        self.preview = None
+        self.data_file = None
+        self.encoder_settings = None  # (quality, bitrate) of the running recording
 
-        # TODO: rework preview logic/handling and in stop()
-        self.lastpreviewimg = time.time()
-        self.previewimage = None
+    @property
+    def direct_write(self) -> bool:
+        return self.options.get("direct_write", False)
 
     def offer(self) -> List[str]:
-        # TODO: support topics
-        return ["all"]
+        # "all": H264 data with frame info (unless written directly), "frame": frame
+        # info only, "preview": low resolution greyscale images
+        return ["frame", "preview"] if self.direct_write else ["all", "frame", "preview"]
 
     def _start_impl(self):
         if not self.impl:
@@ -45,43 +172,76 @@ class Sensor(base.Publisher):
             if self.dry_run:
                 self.impl.start_preview()
                 self.impl.preview.alpha = 128
-            self.impl.start_recording(self, format=self.options["format"], quality=self.options["quality"])
+            elif self.direct_write:
+                self.data_file = open_video_file(self.writer, self.options)
+            self._start_video(self.options["quality"], self.options.get("bitrate", 17000000))
+
+            if self.options.get("preview_framerate", 0) > 0:
+                resolution = (self.options.get("preview_width", 128), self.options.get("preview_height", 64))
+                self.preview = Preview(self, resolution, self.options["preview_framerate"])
+                self.preview.start()
+
+    def adjust(self, changes: Dict[str, Any]) -> bool:
+        # "quality"/"bitrate" restart the encoder, "preview_framerate" throttles the preview.
+        applied = False
+        if self.impl and ("quality" in changes or "bitrate" in changes):
+            settings = (changes.get("quality", self.encoder_settings[0]), changes.get("bitrate", self.encoder_settings[1]))
+            if settings != self.encoder_settings:
+                # The rate control cannot change while recording. The new stream
+                # continues in the same output, starting with SPS headers and a keyframe.
+                self.impl.stop_recording(splitter_port=VIDEO_SPLITTER_PORT)
+                self._start_video(*settings)
+                logging.info(f"{self.name} encoder restarted with quality {settings[0]}, bitrate {settings[1]}")
+            applied = True
+        if self.preview and "preview_framerate" in changes:
+            self.preview.set_framerate(changes["preview_framerate"])
+            applied = True
+        return applied
+
+    def _start_video(self, quality: int, bitrate: int):
+        self.impl.start_recording(self, format=self.options["format"], quality=quality, bitrate=bitrate, splitter_port=VIDEO_SPLITTER_PORT)
+        self.encoder_settings = (quality, bitrate)
 
     def _stop_impl(self):
         if self.impl:
             if self.dry_run:
                 self.impl.stop_preview()
-            self.impl.stop_recording()
+            if self.preview:
+                self.preview.stop()
+                self.preview = None
+            self.impl.stop_recording(splitter_port=VIDEO_SPLITTER_PORT)
             self.impl.close()
             self.impl = None
 
-    def write(self, image):
-        current_time = time.time()
-        if current_time - self.lastpreviewimg >= .5:
-            stream = io.BytesIO()
-            self.impl.capture(stream, use_video_port=True, format="jpeg", resize=(320,200))
-            stream.seek(0)
-            self.previewimage = Image.open(stream)
-            self.lastpreviewimg = current_time
+        if self.data_file:
+            self.data_file.close()
+            self.data_file = None
 
-        data = {
-            "frame": self.impl.frame,
-            "image": image,
-            "preview": self.previewimage,
-        }
-
-        # TODO: create classes for payload-types
-        self.publish("all", data)
+    def write(self, image):
+        # Encoder callback: pass the data on, nothing else.
+        frame = self.impl.frame
+        timestamp = time.time()  # Same time for the video file and picam.csv
+        if self.data_file:
+            # picamera hands over an immutable bytes object, so the writer can
+            # keep it until written instead of copying it.
+            self.data_file.write(image, frame, timestamp)
+        else:
+            # TODO: create classes for payload-types
+            self.publish("all", {
+                "frame": frame,
+                "image": image,
+            }, timestamp)
+        self.publish("frame", frame, timestamp)
 
 
 class Output(base.Subscriber):
     def __init__(self, options: Dict[str, Any]):
         super().__init__(options)
 
-        self.data_path = os.path.join(self.out_dir, self.options["output_data"])
+        self.data_path = data_path(self.options)
         self.metadata_path = os.path.join(self.out_dir, self.options["output_metadata"])
 
-        self.data_fd = None
+        self.data_file = None
         self.metadata_fd = None
 
         self.frame_cnt = 0
@@ -89,9 +249,14 @@ class Output(base.Subscriber):
         self.metadata_header_written = False
         self.metadata = []
 
+    @property
+    def direct_write(self) -> bool:
+        return self.options.get("direct_write", False)
+
     def _start_impl(self):
-        self.data_fd = open(self.data_path, "wb")
-        self.metadata_fd = open(self.metadata_path, "w")
+        if not self.direct_write:
+            self.data_file = open_video_file(self.writer, self.options)
+        self.metadata_fd = diskwriter.open_file(self.writer, self.metadata_path)
 
         self.frame_cnt = 0
         self.incomplete_frames = []
@@ -101,20 +266,26 @@ class Output(base.Subscriber):
     def _stop_impl(self):
         self.flush()
 
-        if self.data_fd:
-            self.data_fd.close()
-            self.data_fd = None
+        if self.data_file:
+            self.data_file.close()
+            self.data_file = None
 
         if self.metadata_fd:
             self.metadata_fd.close()
             self.metadata_fd = None
 
-    def on_process_message(self, msg: base.Message):
-        # Always write data
-        self.data_fd.write(msg.data["image"])
+    def topics(self, publisher: base.Publisher) -> List[str]:
+        # With direct writes the sensor already stored the data, only the frame info is left.
+        return ["frame"] if self.direct_write else ["all"]
 
+    def on_process_message(self, msg: base.Message):
         timestamp = msg.timestamp
-        frame = msg.data["frame"]
+        if msg.topic == "frame":
+            frame = msg.data
+        else:
+            # Always write data
+            frame = msg.data["frame"]
+            self.data_file.write(msg.data["image"], frame, timestamp)
 
         if frame.complete is False:
             self.incomplete_frames.append((timestamp, frame))
@@ -147,10 +318,12 @@ class Output(base.Subscriber):
 
     def flush(self):
         if self.metadata_fd:
-            writer = csv.writer(self.metadata_fd)
+            buf = io.StringIO()
+            writer = csv.writer(buf)
             if not self.metadata_header_written:
                 writer.writerow(["timestamp", "frame_num", "frame_type", "frame_size", "video_size"])
                 self.metadata_header_written = True
             writer.writerows(self.metadata)
+            self.metadata_fd.write(buf.getvalue().encode("utf-8"))
         self.metadata.clear()
         logging.info("PiCamera metadata output flushed")
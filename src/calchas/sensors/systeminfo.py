@@ -1,16 +1,19 @@
 import csv
 import datetime
+import io
 import logging
+import multiprocessing
 import os
-import platform
-import subprocess
 import threading
 import time
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Tuple
 
 import psutil
 
-from calchas.common import base
+from calchas.common import base, diskwriter, raspi, recfile, runtime
+
+
+THREAD_FIELDS = ["kind", "id", "name", "cpu_percent", "cpu_time_user", "cpu_time_system", "mem_rss_percent"]
 
 
 class Sensor(base.Publisher):
@@ -18,62 +21,95 @@ class Sensor(base.Publisher):
         super().__init__(options)
 
         self.impl = None
-        self.read_thread = None
+        self.worker = None
         self.request_stop = False
+        self.frequency = self.options.get("frequency", 1.)
 
     def offer(self) -> List[str]:
-        # TODO: support topics
-        return ["all"]
+        # "threads": one row per thread and child process, see SensorImpl.read_threads()
+        return ["all", "threads"]
+
+    def adjust(self, changes: Dict[str, Any]) -> bool:
+        if changes.get("frequency", 0) > 0:
+            self.frequency = changes["frequency"]  # Used from the next row on
+            return True
+        return False
 
     def _start_impl(self) -> None:
         if not self.impl:
-            if platform.system() == "Linux" and os.uname()[4][:3] == "arm":  # TODO: identify raspberry pi
-                self.impl = SensorImplRaspi(self.out_dir)
-            else:
-                # Generic implementation
-                self.impl = SensorImpl(self.out_dir)
+            self.impl = SensorImpl(self.out_dir)
 
         self.request_stop = False
-        if not self.read_thread:
-            logging.info("Starting system info thread...")
-            self.read_thread = threading.Thread(target=self._read_thread_fn)
-            self.read_thread.start()
-            logging.info(f"System info thread started.")
+        if not self.worker:
+            logging.info("Starting system info loop...")
+            self.worker = runtime.Worker(self.name, self._read_steps, self.runtime)
+            self.worker.start()
+            logging.info(f"System info loop started.")
 
     def _stop_impl(self) -> None:
         self.request_stop = True
-        if self.read_thread:
-            self.read_thread.join()
-            self.read_thread = None
+        if self.worker:
+            self.worker.stop()
+            self.worker = None
 
-    def _read_thread_fn(self) -> None:
-        frequency_sleep_sec = 1. / self.options.get("frequency", 1.)
+        if self.impl:
+            self.impl.close()
+            self.impl = None
+
+    def _read_steps(self) -> runtime.Steps:
+        intervals = self.options.get("group_intervals", {})
+        groups = [("system", self.impl.read_system), ("process", self.impl.read_process), ("disk", self.impl.read_disk)]
+        last_read = {}
+        data = {}
+        # The CPU percentages are deltas to the baseline taken by SensorImpl; a
+        # first row right after it would see no CPU time at all (0% idle).
+        yield 1. / self.frequency
         while not self.request_stop:
-            data = {}
-            data.update(self.impl.read_system())
-            data.update(self.impl.read_process())
-            data.update(self.impl.read_disk())
+            frequency_sleep_sec = 1. / self.frequency
+            now = time.time()
+            for group, read in groups:
+                # Groups with a longer interval repeat their last values in between.
+                if group not in last_read or now - last_read[group] >= intervals.get(group, 0.) - frequency_sleep_sec / 2:
+                    data.update(read())
+                    last_read[group] = now
 
             # TODO: create classes for payload-types
-            self.publish("all", data)
+            self.publish("all", dict(data))
+
+            if self.has_subscribers("threads") and ("threads" not in last_read or now - last_read["threads"] >= intervals.get("threads", 0.) - frequency_sleep_sec / 2):
+                self.publish("threads", self.impl.read_threads())
+                last_read["threads"] = now
 
-            time.sleep(frequency_sleep_sec - time.time() % frequency_sleep_sec)
+            yield frequency_sleep_sec - time.time() % frequency_sleep_sec
 
 
 class SensorImpl:
+    """Reads each value once per sample: no subprocesses, no repeated psutil calls."""
     def __init__(self, out_dir: str):
         self.process = psutil.Process(os.getpid())
-        self.out_dir = out_dir
+        self.total_memory = psutil.virtual_memory().total
+        self.health = raspi.HealthSensors()
+        self.mount_point = self._find_mount_point(out_dir)
+        self._last_cpu_times: Dict[Tuple[str, int], Tuple[float, float]] = {}  # (kind, id) -> (time, cpu time)
+        # Baselines; the first row must be read at least one interval later
+        psutil.cpu_percent()
+        psutil.cpu_times_percent()
+
+    def close(self) -> None:
+        self.health.close()
 
     def read_system(self) -> Dict[str, Any]:
         cpu_times_percent = psutil.cpu_times_percent()
         loadavg = psutil.getloadavg()
+        temp = self.health.cpu_temp()
+        throttled = self.health.throttled()
         return {
             "system_cpu_percent": psutil.cpu_percent(),
             "system_cpu_times_percent_system": cpu_times_percent.system,
             "system_cpu_times_percent_user": cpu_times_percent.user,
             "system_cpu_times_percent_idle": cpu_times_percent.idle,
-            "system_cpu_temp": 0,
+            "system_cpu_temp": temp if temp is not None else 0,
+            "system_throttled": throttled if throttled is not None else 0,
             "system_loadavg_1": loadavg[0],
             "system_loadavg_5": loadavg[1],
             "system_loadavg_15": loadavg[2],
@@ -82,24 +118,83 @@ class SensorImpl:
 
     def read_process(self) -> Dict[str, Any]:
         with self.process.oneshot():
+            cpu_times = self.process.cpu_times()
+            memory = self.process.memory_info()
             return {
                 "process_cpu_percent": self.process.cpu_percent(),
-                "process_cpu_time_system": self.process.cpu_times().system,
-                "process_cpu_time_user": self.process.cpu_times().user,
-                "process_mem_rss_percent": self.process.memory_percent(memtype="rss"),
-                "process_mem_vms_percent": self.process.memory_percent(memtype="vms"),
+                "process_cpu_time_system": cpu_times.system,
+                "process_cpu_time_user": cpu_times.user,
+                "process_mem_rss_percent": 100. * memory.rss / self.total_memory,
+                "process_mem_vms_percent": 100. * memory.vms / self.total_memory,
             }
 
     def read_disk(self) -> Dict[str, Any]:
-        output_part = self._find_mount_point(self.out_dir)
         try:
-            _, _, _, percent = psutil.disk_usage(output_part)
+            _, _, _, percent = psutil.disk_usage(self.mount_point)
             return {"disk_percent": percent}
         except PermissionError as e:
-            logging.debug(f"Exception accessing {output_part}: {e}")
+            logging.debug(f"Exception accessing {self.mount_point}: {e}")
             return {"disk_percent": 0}
 
-    def _find_mount_point(self, path: str) -> str:
+    def read_threads(self) -> List[Dict[str, Any]]:
+        """CPU time of every thread of this process and CPU time and memory of every child process.
+
+        Threads are identified by their Python name (falling back to the kernel's
+        name for threads started by native code), so the recorder's threads can
+        be told apart across trips.
+        """
+        now = time.time()
+        rows = []
+        names = {t.native_id: t.name for t in threading.enumerate()}
+        try:
+            threads = self.process.threads()
+        except psutil.Error as e:
+            logging.debug(f"Failed reading threads: {e}")
+            threads = []
+        for t in threads:
+            name = names.get(t.id) or self._kernel_thread_name(t.id)
+            rows.append(self._cpu_row(now, "thread", t.id, name, t.user_time, t.system_time))
+
+        # Processes started by the recorder (e.g. sensors with "process") carry the sensor's name.
+        child_names = {p.pid: p.name for p in multiprocessing.active_children()}
+        for child in self.process.children(recursive=True):
+            try:
+                with child.oneshot():
+                    cpu_times = child.cpu_times()
+                    row = self._cpu_row(now, "process", child.pid, child_names.get(child.pid) or child.name(), cpu_times.user, cpu_times.system)
+                    row["mem_rss_percent"] = 100. * child.memory_info().rss / self.total_memory
+                    rows.append(row)
+            except psutil.Error:
+                pass  # Exited meanwhile
+
+        alive = {(row["kind"], row["id"]) for row in rows}
+        self._last_cpu_times = {k: v for k, v in self._last_cpu_times.items() if k in alive}
+        return rows
+
+    def _cpu_row(self, now: float, kind: str, id: int, name: str, user: float, system: float) -> Dict[str, Any]:
+        last_time, last_cpu = self._last_cpu_times.get((kind, id), (None, None))
+        cpu_percent = 100. * (user + system - last_cpu) / (now - last_time) if last_time and now > last_time else 0.
+        self._last_cpu_times[(kind, id)] = (now, user + system)
+        return {
+            "kind": kind,
+            "id": id,
+            "name": name,
+            "cpu_percent": round(cpu_percent, 1),
+            "cpu_time_user": user,
+            "cpu_time_system": system,
+            "mem_rss_percent": None,  # Threads share the process memory
+        }
+
+    @staticmethod
+    def _kernel_thread_name(tid: int) -> str:
+        try:
+            with open(f"/proc/self/task/{tid}/comm") as f:
+                return f.read().strip()
+        except OSError:
+            return str(tid)
+
+    @staticmethod
+    def _find_mount_point(path: str) -> str:
         """Based on https://stackoverflow.com/a/4453715."""
         mount_point = os.path.abspath(path)
         while not os.path.ismount(mount_point):
@@ -107,35 +202,38 @@ class SensorImpl:
         return mount_point
 
 
-class SensorImplRaspi(SensorImpl):
-    def __init__(self, out_dir: str):
-        super().__init__(out_dir)
-
-    def read_system(self) -> Dict[str, Any]:
-        def get_cpu_temp():
-            # TODO: better error handling
-            # TODO: handle SIGNINT, e.g.: subprocess.CalledProcessError: Command 'vcgencmd measure_temp' died with <Signals.SIGINT: 2>
-            return float(subprocess.check_output("vcgencmd measure_temp", shell=True).decode("utf-8").split("=")[1].split("\'")[0])
-
-        state = super().read_system()
-        state["system_cpu_temp"] = get_cpu_temp()
-        return state
-
-
 class Output(base.Subscriber):
     def __init__(self, options: Dict[str, Any]):
         super().__init__(options)
 
-        self.fpath = os.path.join(self.out_dir, self.options["output"])
+        self.binary = self.options.get("output_format", "csv") == "binary"
+        self.fpath = os.path.join(self.out_dir, self.options["output_binary" if self.binary else "output"])
         self.fd = None
         self.header_written = False
+        self.rec_writer = None
         self.data = []
 
+        # Thread rows are always CSV; their names are not numeric.
+        self.threads_fpath = os.path.join(self.out_dir, self.options["output_threads"]) if self.options.get("output_threads") else None
+        self.threads_fd = None
+        self.threads_data = []
+
+    def topics(self, publisher: base.Publisher) -> List[str]:
+        return publisher.offer() if self.threads_fpath else ["all"]
+
     def _start_impl(self):
-        self.fd = open(self.fpath, "w", newline="")
+        self.fd = diskwriter.open_file(self.writer, self.fpath)
         self.header_written = False
+        self.rec_writer = None
         self.data = []
 
+        if self.threads_fpath:
+            self.threads_fd = diskwriter.open_file(self.writer, self.threads_fpath)
+            buf = io.StringIO()
+            csv.writer(buf).writerow(["timestamp"] + THREAD_FIELDS)
+            self.threads_fd.write(buf.getvalue().encode("utf-8"))
+        self.threads_data = []
+
     def _stop_impl(self):
         self.flush()
 
@@ -143,21 +241,46 @@ class Output(base.Subscriber):
             self.fd.close()
             self.fd = None
 
+        if self.threads_fd:
+            self.threads_fd.close()
+            self.threads_fd = None
+
     def on_process_message(self, msg: base.Message):
-        new_data = {"timestamp": msg.timestamp}
-        new_data.update(msg.data)
-        self.data.append(new_data)
+        self.on_process_batch([msg])
+
+    def on_process_batch(self, messages: List[base.Message]):
+        for msg in messages:
+            if msg.topic == "threads":
+                self.threads_data += [[msg.timestamp] + [row[k] for k in THREAD_FIELDS] for row in msg.data]
+                continue
+            new_data = {"timestamp": msg.timestamp}
+            new_data.update(msg.data)
+            self.data.append(new_data)
 
         # Write data to disk every X entries
-        if len(self.data) % self.options["output_write_threshold"] == 0:
+        if len(self.data) >= self.options["output_write_threshold"]:
             self.flush()
 
     def flush(self):
         if self.fd and self.data:
-            writer = csv.DictWriter(self.fd, fieldnames=self.data[0].keys())
-            if not self.header_written:
-                writer.writeheader()
-                self.header_written = True
-            writer.writerows(self.data)
+            if self.binary:
+                if not self.rec_writer:
+                    self.rec_writer = recfile.RecordWriter(self.fd, recfile.fields_from_keys(self.data[0].keys(), "d"))
+                names = self.rec_writer.names
+                self.rec_writer.write_rows([[d[k] for k in names] for d in self.data])
+            else:
+                buf = io.StringIO()
+                writer = csv.DictWriter(buf, fieldnames=self.data[0].keys())
+                if not self.header_written:
+                    writer.writeheader()
+                    self.header_written = True
+                writer.writerows(self.data)
+                self.fd.write(buf.getvalue().encode("utf-8"))
         self.data.clear()
+
+        if self.threads_fd and self.threads_data:
+            buf = io.StringIO()
+            csv.writer(buf).writerows(self.threads_data)
+            self.threads_fd.write(buf.getvalue().encode("utf-8"))
+        self.threads_data.clear()
         logging.info("System info output flushed")
@@ -0,0 +1,114 @@
+import csv
+import io
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from calchas.common import base, diskwriter, runtime
+
+FIELDS = ["kind", "name", "topic", "messages", "rate", "queue_depth", "queue_size", "dropped",
+          "latency_avg_ms", "latency_max_ms", "processing_avg_ms", "processing_max_ms"]
+
+
+class Sensor(base.Publisher):
+    """Publishes the message bus counters of all recorder components on "telemetry".
+
+    Each message is a list of rows (see FIELDS): one per publisher topic with
+    its message rate, and one per subscriber with its queue and the latency and
+    processing time of the messages it handled since the previous message.
+    """
+    def __init__(self, options: Dict[str, Any]):
+        super().__init__(options)
+
+        self.components_fn: Optional[Callable[[], Iterable[Any]]] = None
+        self.worker = None
+        self.request_stop = False
+
+    def offer(self) -> List[str]:
+        return ["telemetry"]
+
+    def watch(self, components_fn: Callable[[], Iterable[Any]]) -> None:
+        self.components_fn = components_fn
+
+    def _start_impl(self) -> None:
+        self.request_stop = False
+        if not self.worker:
+            self.worker = runtime.Worker(self.name, self._read_steps, self.runtime)
+            self.worker.start()
+
+    def _stop_impl(self) -> None:
+        self.request_stop = True
+        if self.worker:
+            self.worker.stop()
+            self.worker = None
+
+    def _read_steps(self) -> runtime.Steps:
+        frequency_sleep_sec = 1. / self.options.get("frequency", 1.)
+        last_published = {}
+        last_time = time.time()
+        while not self.request_stop:
+            yield frequency_sleep_sec - time.time() % frequency_sleep_sec
+
+            now = time.time()
+            elapsed = now - last_time
+            last_time = now
+            rows = []
+            for c in (self.components_fn() if self.components_fn else []):
+                if isinstance(c, base.Publisher):
+                    for topic, count in c.telemetry()["published"].items():
+                        messages = count - last_published.get((c, topic), 0)
+                        last_published[(c, topic)] = count
+                        rows.append(self._row("publisher", c.name, topic, messages=messages, rate=messages / elapsed))
+                elif isinstance(c, base.Subscriber):
+                    values = c.telemetry()
+                    values["messages"] = values.pop("processed")
+                    values["rate"] = values["messages"] / elapsed
+                    rows.append(self._row("subscriber", c.name, None, **values))
+
+            self.publish("telemetry", rows, now)
+
+    @staticmethod
+    def _row(kind: str, name: str, topic: Optional[str], **values) -> Dict[str, Any]:
+        row = dict.fromkeys(FIELDS)
+        row.update(kind=kind, name=name, topic=topic, **values)
+        return row
+
+
+class Output(base.Subscriber):
+    def __init__(self, options: Dict[str, Any]):
+        super().__init__(options)
+
+        self.fpath = os.path.join(self.out_dir, self.options["output"])
+        self.fd = None
+        self.data = []
+
+    def _start_impl(self):
+        self.fd = diskwriter.open_file(self.writer, self.fpath)
+        buf = io.StringIO()
+        csv.writer(buf).writerow(["timestamp"] + FIELDS)
+        self.fd.write(buf.getvalue().encode("utf-8"))
+        self.data = []
+
+    def _stop_impl(self):
+        self.flush()
+
+        if self.fd:
+            self.fd.close()
+            self.fd = None
+
+    def on_process_message(self, msg: base.Message):
+        for row in msg.data:
+            self.data.append([msg.timestamp] + [round(v, 3) if isinstance(v, float) else v for v in (row[k] for k in FIELDS)])
+
+        # Write data to disk every X entries
+        if len(self.data) >= self.options["output_write_threshold"]:
+            self.flush()
+
+    def flush(self):
+        if self.fd and self.data:
+            buf = io.StringIO()
+            csv.writer(buf).writerows(self.data)
+            self.fd.write(buf.getvalue().encode("utf-8"))
+        self.data.clear()
+        logging.debug("Telemetry output flushed")
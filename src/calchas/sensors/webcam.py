@@ -1,28 +1,168 @@
+import collections
+import concurrent.futures
 import csv
 import datetime
 import logging
 import os
 import threading
 import time
-from typing import Any, Dict, List
+import weakref
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
 
 import cv2
+import numpy as np
 
-from calchas.common import base
+from calchas.common import avi, base, diskwriter
 
 import io
 from PIL import Image
 
 
+class JpegFrame(dict):
+    """Payload of a pass-through frame.
+
+    "jpeg" holds the frame as delivered by the camera; "image" is only decoded
+    (and rotated) when a subscriber accesses it.
+    """
+    def __init__(self, jpeg, rotation: int):
+        super().__init__(jpeg=jpeg)
+        self.rotation = rotation
+
+    def __missing__(self, key: str):
+        if key != "image":
+            raise KeyError(key)
+        image = cv2.imdecode(self["jpeg"], cv2.IMREAD_COLOR)
+        if self.rotation == 180:
+            image = cv2.rotate(image, cv2.ROTATE_180)
+        self["image"] = image
+        return image
+
+
+class PooledFrame(dict):
+    """Payload whose image buffer goes back to its FramePool once the payload is garbage."""
+
+
+class FramePool:
+    """Reusable frame buffers.
+
+    Buffers are allocated on demand up to "size"; after that memory stays flat.
+    A buffer is handed out again once no message references its payload anymore,
+    i.e. after all subscribers dropped it. If every buffer is in use, a new
+    unpooled one is allocated rather than stalling the camera.
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self.allocated = 0
+        self.exhausted = 0
+        self._free: List[np.ndarray] = []
+        self._lock = threading.Lock()
+
+    def acquire(self, shape: Tuple[int, ...]) -> Optional[np.ndarray]:
+        with self._lock:
+            while self._free:
+                buf = self._free.pop()
+                if buf.shape == shape:
+                    return buf
+                self.allocated -= 1  # The resolution changed; let it go
+            if self.allocated < self.size:
+                self.allocated += 1
+                return np.empty(shape, dtype=np.uint8)
+            self.exhausted += 1
+            return None
+
+    def release(self, buf: np.ndarray) -> None:
+        with self._lock:
+            self._free.append(buf)
+
+    def payload(self, buf: np.ndarray) -> PooledFrame:
+        data = PooledFrame(image=buf)
+        weakref.finalize(data, self.release, buf)
+        return data
+
+
+class BandwidthBudget:
+    """Token bucket over the bytes a camera publishes per second (0 disables it).
+
+    Several cameras share the CPU, the disk and usually the USB bus; the budget
+    keeps one of them from starving the others. A frame passes while there are
+    tokens left and may take the bucket into debt, so frames larger than one
+    second of budget still get through at a lower rate. The output fills the
+    skipped frames in, the video keeps its frame rate.
+    """
+    def __init__(self, mbps: float):
+        self.rate = mbps * 1e6 / 8
+        self.tokens = self.rate
+        self.last = time.monotonic()
+        self.skipped = 0
+
+    def allow(self, size: int) -> bool:
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens <= 0:
+            self.skipped += 1
+            return False
+        self.tokens -= size
+        return True
+
+
+class ParallelJpegEncoder:
+    """Compresses consecutive frames on a pool of threads and hands them back in order.
+
+    cv2.imencode releases the GIL, so the workers use separate cores. At most
+    "max_pending" frames are in flight; submit() waits for the oldest one
+    beyond that, which backs up into the subscriber queue.
+    """
+    def __init__(self, name: str, workers: int, quality: int, max_pending: int):
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        self.max_pending = max_pending
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix=f"{name}-jpeg")
+        self._pending: Deque[Tuple[concurrent.futures.Future, Any]] = collections.deque()
+
+    def submit(self, payload: Dict[str, Any], tag: Any) -> None:
+        # The payload, not just its image, stays referenced until the frame is
+        # encoded, so a pooled buffer is not reused underneath the worker.
+        self._pending.append((self._executor.submit(self._encode, payload), tag))
+
+    def completed(self) -> Iterator[Tuple[Any, np.ndarray]]:
+        """Encoded frames, in submission order, that are ready now (or needed to make room)."""
+        while self._pending and (self._pending[0][0].done() or len(self._pending) > self.max_pending):
+            future, tag = self._pending.popleft()
+            yield tag, future.result()
+
+    def close(self) -> Iterator[Tuple[Any, np.ndarray]]:
+        """Waits for all remaining frames."""
+        while self._pending:
+            future, tag = self._pending.popleft()
+            yield tag, future.result()
+        self._executor.shutdown()
+
+    def _encode(self, payload: Dict[str, Any]) -> np.ndarray:
+        ok, jpeg = cv2.imencode(".jpg", payload["image"], self.params)
+        if not ok:
+            raise RuntimeError("JPEG encoding failed")
+        return jpeg
+
+
 class Sensor(base.Publisher):
     def __init__(self, options: Dict[str, Any]):
         super().__init__(options)
 
         self.impl = None
         self.frame_cnt = 0
+        self.pool = None
+        self.budget = None
+        self.frame_interval_sec = None  # Set when the frame rate is lowered while running
+        self.next_frame = 0.
         self.read_thread = None
         self.request_stop = False
 
+    @property
+    def passthrough(self) -> bool:
+        return self.options.get("capture", "decode") == "mjpeg"
+
     def offer(self) -> List[str]:
         # TODO: support topics
         return ["all"]
@@ -33,12 +173,24 @@ class Sensor(base.Publisher):
             self.impl.set(cv2.CAP_PROP_FRAME_WIDTH, self.options["width"])
             self.impl.set(cv2.CAP_PROP_FRAME_HEIGHT, self.options["height"])
             self.impl.set(cv2.CAP_PROP_FPS, self.options["framerate"])
+            if self.passthrough:
+                # Let the device compress and hand over the JPEG data as is.
+                mjpg = cv2.VideoWriter_fourcc(*"MJPG")
+                self.impl.set(cv2.CAP_PROP_FOURCC, mjpg)
+                self.impl.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+                # Raw frames wrapped as JPEG would make a corrupt video.
+                fourcc = int(self.impl.get(cv2.CAP_PROP_FOURCC))
+                if fourcc != mjpg:
+                    self.impl.release()
+                    self.impl = None
+                    raise RuntimeError(f"{self.name} does not deliver MJPEG (FOURCC {fourcc & 0xFFFFFFFF:#010x}), "
+                                       f"use capture \"decode\"")
 
         self.frame_cnt = 0
         self.request_stop = False
         if not self.read_thread:
             logging.info("Setting up webcam thread...")
-            self.read_thread = threading.Thread(target=self._read_thread_fn)
+            self.read_thread = threading.Thread(target=self._read_thread_fn, name=self.name)
             self.read_thread.start()
             logging.info(f"Webcam thread started.")
 
@@ -52,23 +204,81 @@ class Sensor(base.Publisher):
             self.impl.release()
             self.impl = None
 
+        if self.pool:
+            if self.pool.exhausted:
+                logging.warning(f"Webcam frame pool of {self.pool.size} buffers was exhausted {self.pool.exhausted} times")
+            self.pool = None
+
+        if self.budget and self.budget.skipped:
+            logging.warning(f"{self.name} skipped {self.budget.skipped} frames over its (last) bandwidth budget")
+
+    def adjust(self, changes: Dict[str, Any]) -> bool:
+        applied = False
+        if "bandwidth_mbps" in changes:
+            self.budget = BandwidthBudget(changes["bandwidth_mbps"])
+            applied = True
+        if "framerate" in changes:
+            # The capture keeps its rate; frames above the new one are skipped (the
+            # output repeats frames, so the video keeps its rate). The interval
+            # leaves room for jitter, so the configured rate passes every frame.
+            framerate = changes["framerate"]
+            self.frame_interval_sec = 0.8 / framerate if 0 < framerate < self.options["framerate"] else None
+            applied = True
+        return applied
+
+    def _want_frame(self, size: int) -> bool:
+        if self.frame_interval_sec:
+            now = time.monotonic()
+            if now < self.next_frame:
+                return False
+            self.next_frame = now + self.frame_interval_sec
+        return self.budget.allow(size)
+
     def _read_thread_fn(self):
+        self.budget = BandwidthBudget(self.options.get("bandwidth_mbps", 0))
+        if not self.passthrough:
+            self.pool = FramePool(self.options.get("buffer_pool_size", 40))
+        rotate = self.options["rotation"] == 180
+        shape = (self.options["height"], self.options["width"], 3)
+        scratch = None  # Read buffer when rotating; only the rotated copy is published
+
         while not self.request_stop:
-            retval, image = self.impl.read()
+            buf = self.pool.acquire(shape) if self.pool else None
+            target = scratch if rotate else buf
+            retval, image = self.impl.read(target) if target is not None else self.impl.read()
             if not retval:
                 logging.error(f"Failed reading image frame #{self.frame_cnt + 1} from webcam. Shutting down sensor.")
                 # TODO: report error to monitoring; thow exception?
                 break
 
             self.frame_cnt += 1
-            if self.options["rotation"] == 180:
-                image = cv2.rotate(image, cv2.ROTATE_180)
+            if not self._want_frame(image.nbytes):
+                if buf is not None:
+                    self.pool.release(buf)  # Not published, reuse it right away
+                continue
+
+            if self.passthrough:
+                self.publish("all", JpegFrame(image.reshape(-1), self.options["rotation"]))
+                continue
 
-            data = {
-                "image": image,
-            }
+            # The device may deliver another resolution than configured.
+            shape = image.shape
+            if rotate:
+                scratch = image
+                if buf is not None and buf.shape != shape:
+                    self.pool.release(buf)
+                    buf = self.pool.acquire(shape)
+                frame = buf if buf is not None else np.empty(shape, dtype=np.uint8)
+                cv2.flip(image, -1, frame)
+            else:
+                frame = image
+                if buf is not None and image is not buf:
+                    # read() allocated a new image instead of filling the pooled one.
+                    self.pool.release(buf)
+                    buf = None
 
-            self.publish("all", data)
+            # TODO: create classes for payload-types
+            self.publish("all", self.pool.payload(frame) if buf is not None else {"image": frame})
 
 
 class Output(base.Subscriber):
@@ -79,42 +289,99 @@ class Output(base.Subscriber):
         self.metadata_path = os.path.join(self.out_dir, self.options["output_metadata"])
 
         self.data_writer = None
+        self.avi_writer = None
+        self.encoder = None
         self.metadata_fd = None
 
-        self.frame_cnt = 0
+        self.start_time = None
+        self.video_frames = 0  # Frames in the video so far, including repeated ones
         self.metadata_header_written = False
         self.metadata = []
 
     def _start_impl(self):
-        fourcc = cv2.VideoWriter_fourcc(*self.options["format"])
-        self.data_writer = cv2.VideoWriter(self.data_path, fourcc, self.options["framerate"], (self.options["width"], self.options["height"]))
-        self.metadata_fd = open(self.metadata_path, "w", newline="")
+        passthrough = self.options.get("capture", "decode") == "mjpeg"
+        # Pass-through frames are written as delivered; re-encoding them would decode each one first.
+        workers = 0 if passthrough else self.options.get("encode_workers", 0)
+        if workers and self.options["format"] != "MJPG":
+            logging.warning(f"encode_workers needs format MJPG, encoding {self.options['format']} on one thread")
+            workers = 0
 
-        self.frame_cnt = 0
+        if passthrough or workers:
+            self.avi_writer = avi.AviWriter(diskwriter.open_file(self.writer, self.data_path), self.data_path,
+                self.options["width"], self.options["height"], self.options["framerate"])
+            if workers:
+                self.encoder = ParallelJpegEncoder(self.name, workers, self.options.get("jpeg_quality", 95), 2 * workers)
+        else:
+            fourcc = cv2.VideoWriter_fourcc(*self.options["format"])
+            self.data_writer = cv2.VideoWriter(self.data_path, fourcc, self.options["framerate"], (self.options["width"], self.options["height"]))
+        self.metadata_fd = diskwriter.open_file(self.writer, self.metadata_path)
+
+        self.start_time = None
+        self.video_frames = 0
         self.metadata_header_written = False
         self.metadata = []
 
     def _stop_impl(self):
+        if self.encoder:
+            for timestamp, jpeg in self.encoder.close():
+                self._write_jpeg(jpeg, timestamp)
+            self.encoder = None
+
         self.flush()
 
         if self.data_writer:
             self.data_writer.release()
-            self.data_fd = None
+            self.data_writer = None
+
+        if self.avi_writer:
+            self.avi_writer.close()
+            self.avi_writer = None
 
         if self.metadata_fd:
             self.metadata_fd.close()
             self.metadata_fd = None
 
+    def adjust(self, changes: Dict[str, Any]) -> bool:
+        if self.encoder and "jpeg_quality" in changes:
+            self.encoder.params = [cv2.IMWRITE_JPEG_QUALITY, changes["jpeg_quality"]]
+            return True
+        return False
+
     def on_process_message(self, msg: base.Message):
-        image = msg.data["image"]
-        self.data_writer.write(image)
+        if self.encoder:
+            self.encoder.submit(msg.data, msg.timestamp)
+            for timestamp, jpeg in self.encoder.completed():
+                self._write_jpeg(jpeg, timestamp)
+        elif self.avi_writer:
+            self._write_jpeg(msg.data["jpeg"], msg.timestamp)
+        else:
+            image = msg.data["image"]
+            # VideoWriter cannot write empty frames; the new one stands in for the missed ones.
+            for _ in range(self._missed_frames(msg.timestamp) + 1):
+                self.data_writer.write(image)
+            self._add_metadata(msg.timestamp, image.size)
 
-        self.frame_cnt += 1
+    def _write_jpeg(self, jpeg: np.ndarray, timestamp: float):
+        self.avi_writer.skip_frames(self._missed_frames(timestamp))
+        self.avi_writer.write_frame(jpeg)
+        self._add_metadata(timestamp, jpeg.size)
+
+    def _missed_frames(self, timestamp: float) -> int:
+        # The video has the configured constant frame rate. Frames the sensor skipped
+        # (lowered framerate, bandwidth budget) are filled in so it keeps in time.
+        if self.start_time is None:
+            self.start_time = timestamp
+        missed = int(round((timestamp - self.start_time) * self.options["framerate"])) - self.video_frames
+        self.video_frames += max(0, missed)
+        return max(0, missed)
+
+    def _add_metadata(self, timestamp: float, frame_size: int):
+        self.video_frames += 1
 
         self.metadata.append([
-            msg.timestamp,
-            self.frame_cnt - 1,
-            image.size,
+            timestamp,
+            self.video_frames - 1,
+            frame_size,
         ])
 
         # Write meta data to disk every X entries
@@ -123,10 +390,79 @@ class Output(base.Subscriber):
 
     def flush(self):
         if self.metadata_fd:
-            writer = csv.writer(self.metadata_fd)
+            buf = io.StringIO()
+            writer = csv.writer(buf)
             if not self.metadata_header_written:
                 writer.writerow(["timestamp", "frame_num", "frame_size"])
                 self.metadata_header_written = True
             writer.writerows(self.metadata)
+            self.metadata_fd.write(buf.getvalue().encode("utf-8"))
         self.metadata.clear()
         logging.info("Webcam metadata output flushed")
+
+
+def video_duration(path: str) -> float:
+    capture = cv2.VideoCapture(path)
+    try:
+        return capture.get(cv2.CAP_PROP_FRAME_COUNT) / capture.get(cv2.CAP_PROP_FPS)
+    finally:
+        capture.release()
+
+
+def metadata_duration(path: str, framerate: float) -> float:
+    with open(path, newline="") as f:
+        timestamps = [float(row["timestamp"]) for row in csv.DictReader(f)]
+    return timestamps[-1] - timestamps[0] + 1. / framerate
+
+
+def main():
+    """Check that recorded videos last as long as their metadata says.
+
+    Usage: python -m calchas.sensors.webcam [webcam0.avi webcam0.csv framerate]
+
+    Without arguments, records synthetic frames across framerate tier changes
+    (10, 5 and 2 frames per second, as with healthmon's thermal tiers) and a
+    bandwidth budget that passes 7 of 10 frames into a temporary directory and
+    reads the videos back.
+    """
+    import sys
+    import tempfile
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
+    if len(sys.argv) > 1:
+        video, metadata = video_duration(sys.argv[1]), metadata_duration(sys.argv[2], float(sys.argv[3]))
+        print(f"video {video:.2f}s, metadata {metadata:.2f}s")
+        sys.exit(0 if abs(video - metadata) <= 1. / float(sys.argv[3]) else 1)
+
+    framerate = 10
+    timestamps = []
+    for tier_framerate, duration_sec in ((10, 5), (5, 5), (2, 5), (10, 5)):
+        start = timestamps[-1] + 1. / framerate if timestamps else 1e9
+        timestamps += [start + i / tier_framerate for i in range(duration_sec * tier_framerate)]
+    start = timestamps[-1] + 1. / framerate
+    timestamps += [start + i / framerate for i in range(5 * framerate) if i % 10 in (0, 1, 3, 4, 6, 7, 9)]
+    image = np.zeros((120, 160, 3), dtype=np.uint8)
+    ok, jpeg = cv2.imencode(".jpg", image)
+
+    failed = False
+    with tempfile.TemporaryDirectory() as out_dir:
+        for capture in ("mjpeg", "decode"):
+            output = Output({
+                "name": f"webcam-{capture}", "out_dir": out_dir, "capture": capture, "format": "MJPG",
+                "output_data": f"{capture}.avi", "output_metadata": f"{capture}.csv", "output_metadata_threshold": 300,
+                "width": image.shape[1], "height": image.shape[0], "framerate": framerate,
+            })
+            output._start_impl()
+            for timestamp in timestamps:
+                output.on_process_message(base.Message(None, "all", {"jpeg": jpeg, "image": image}, timestamp))
+            output._stop_impl()
+
+            video = video_duration(output.data_path)
+            metadata = metadata_duration(output.metadata_path, framerate)
+            failed |= abs(video - metadata) > 1. / framerate
+            print(f"{capture}: {len(timestamps)} frames, video {video:.2f}s, metadata {metadata:.2f}s")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
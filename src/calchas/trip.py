@@ -39,8 +39,7 @@ class Trip:
                     trip_dir = os.path.abspath(os.path.join(self.parent_dir, trip_dir_name))
                     os.makedirs(trip_dir)
                     self.directory = trip_dir
-                    with open(os.path.join(self.directory, Trip.TRIP_OPTIONS_FILE), "w") as f:
-                        json.dump(self.options, f, indent=4)
+                    self.save_options()
                     logging.info(f"Trip directory created: {self.directory}")
                     break
                 except FileExistsError:
@@ -54,20 +53,59 @@ class Trip:
             logging.info(f"Cleaning up trip directory: {self.directory}")
             shutil.rmtree(self.directory)
 
+    def save_options(self) -> None:
+        with open(os.path.join(self.directory, Trip.TRIP_OPTIONS_FILE), "w") as f:
+            json.dump(self.options, f, indent=4)
+
     def default_options(self):
         return {
             "trip": {
                 "version": Trip.TRIP_OPTIONS_VERSION,
             },
+            "recorder": {
+                "runtime": "threads",  # "asyncio": run GPS, IMU, systeminfo and the monitor loops on one event loop
+            },
+            "diskwriter": {
+                "active": True,  # Write output files through one shared background writer
+                "fsync_interval_ms": 1000,  # Sync each file at least once per second (0: never)
+                "fsync_bytes": 4 * 1024 * 1024,  # ...or after this many unsynced bytes (0: never)
+                "max_pending_bytes": 32 * 1024 * 1024,  # Outputs block when this much data is queued
+            },
             "monitors": {
                 "healthmon": {
                     "name": "healthmon",
                     "active": False,
                     "dry-run": False,
                     "frequency": 1,  # Check system health once per second
+                    "queue_size": 10,  # Telemetry messages
+                    "queue_policy": "drop_oldest",
+                    "backlog_threshold": 0.8,  # Warn when a subscriber queue is this full
+                    "latency_threshold_ms": 2000,  # Warn when a subscriber gets messages this late
                     "disk_usage_threshold": 95.0,  # Shut down when <5% disk space is available
-                    "temperature_threshold": 80.0,  # Shut down when temperature is too high
-                    # TODO: monitor under-voltage: https://raspberrypi.stackexchange.com/questions/60593/how-raspbian-detects-under-voltage
+                    "temperature_threshold": 80.0,  # Shut down when temperature is too high (with all thermal tiers applied)
+                    # Thermal tiers are applied while the CPU is hot or the firmware throttles or reports under-voltage.
+                    "thermal_step_down_temp": 75.0,
+                    "thermal_restore_temp": 65.0,
+                    "thermal_dwell_sec": 30,  # Least time between two thermal tier changes
+                    "thermal_tiers": [  # Sensor (or module) name -> options changed while running
+                        {"webcam": {"framerate": 5}, "picam": {"preview_framerate": 0}, "systeminfo": {"frequency": 1}},
+                        {"webcam": {"framerate": 2}, "picam": {"preview_framerate": 0}, "systeminfo": {"frequency": 0.5}},
+                    ],
+                    "output": "healthmon.csv",  # Quality tier transitions
+                    # Disk budget: quality is lowered step by step while the free space, at the
+                    # current write rate, lasts shorter than the rest of the expected drive.
+                    "expected_drive_min": 240,
+                    "min_time_left_min": 30,  # Needed time left once the expected drive is over
+                    "rate_window_sec": 60,  # Write rate measurement window
+                    "tier_dwell_sec": 120,  # Least time between two tier changes
+                    "restore_factor": 1.5,  # Raise the quality again once it would leave this much more time than needed
+                    # Webcam: jpeg_quality only applies with encode_workers; at the default 1280x720
+                    # (decoded, 22 Mbit per frame) the budgets pass about 7 and 4 of 10 frames per second;
+                    # the video repeats frames in between and keeps its length.
+                    "quality_tiers": [  # Sensor (or module) name -> options changed while running
+                        {"picam": {"quality": 30}, "webcam": {"jpeg_quality": 80, "bandwidth_mbps": 150}},
+                        {"picam": {"quality": 35, "bitrate": 8000000}, "webcam": {"jpeg_quality": 60, "bandwidth_mbps": 90}},
+                    ],
                 },
                 "sdd1306": {
                     "name": "sdd1306",
@@ -79,6 +117,8 @@ class Trip:
                     "width": 128,
                     "height": 64,
                     "framerate": 1,
+                    "queue_size": 100,
+                    "queue_policy": "drop_oldest",
                     "gpio_pin_prev": 17,
                     "gpio_pin_next": 27,
                     "gpio_pin_mode": 18,
@@ -86,65 +126,119 @@ class Trip:
                 },
             },
             "sensors": {
+                "telemetry": {
+                    "name": "telemetry",
+                    "active": False,
+                    "dry-run": False,
+                    "frequency": 0.2,  # Message bus counters every 5 seconds
+                    "output": "telemetry.csv",
+                    "output_write_threshold": 100,
+                    "queue_size": 0,  # Unbounded: recorded samples are never dropped
+                    "queue_policy": "block",
+                },
                 "systeminfo": {
                     "name": "systeminfo",
                     "active": False,
                     "dry-run": False,
-                    "frequency": 2,
+                    "frequency": 2,  # Rows per second
+                    "group_intervals": {"system": 0., "process": 0., "disk": 10., "threads": 5.},  # Seconds between reads of a group, 0: every row
                     "output": "systeminfo.csv",
+                    "output_threads": "systeminfo_threads.csv",  # CPU per thread and child process; empty: not recorded
+                    "output_binary": "systeminfo.bin",
+                    "output_format": "csv",  # "csv" or "binary" (see calchas.common.recfile)
                     "output_write_threshold": 20,
+                    "queue_size": 0,  # Unbounded: recorded samples are never dropped
+                    "queue_policy": "block",
                 },
                 "picam": {
                     "name": "picam",
                     "active": False,
                     "dry-run": False,
+                    "process": False,  # Run sensor and output in a child process, frames reach subscribers via shared memory
                     "output_data": "picam.h264",
+                    "output_mp4": "picam.mp4",
+                    "output_index": "picam_index.bin",  # Keyframe offsets of picam.h264 (common.videoindex)
+                    "output_container": "h264",  # "mp4": fragmented MP4 timed by the frame timestamps
+                    "output_fragment_sec": 1.,  # Longest MP4 fragment; a fragment also starts at every keyframe
                     "output_metadata": "picam.csv",
                     "output_metadata_threshold": 300,
+                    "direct_write": False,  # Write the H264 stream from the encoder callback, publish only frame info
+                    "queue_size": 300,
+                    "queue_policy": "block",  # Dropping chunks would corrupt the H264 stream
                     "width": 1920,
                     "height": 1080,
                     "rotation": 180,
                     "framerate": 10,
                     "format": "h264",
                     "quality": 25,
+                    "bitrate": 17000000,  # Upper limit of the H264 encoder (picamera's default)
                     "init_sec": 1.,
+                    "preview_width": 128,  # Greyscale preview from a second splitter port, e.g. for the display
+                    "preview_height": 64,
+                    "preview_framerate": 2,  # 0 disables the preview
                 },
                 "webcam": {
                     "name": "webcam",
                     "active": False,
                     "dry-run": False,
+                    "process": False,  # Run sensor and output in a child process, frames reach subscribers via shared memory
                     "device": 1,  # device used for cv2.VideoCapture()
                     "width": 1280,
                     "height": 720,
                     "rotation": 0,
                     "framerate": 10,
+                    "capture": "decode",  # "mjpeg": record the camera's own MJPEG frames without decoding and re-encoding
                     "format": "MJPG",  # uses a lot of cpu (on RasPi)
+                    "encode_workers": 0,  # >0: compress MJPG frames on this many threads (cores) instead of one
+                    "jpeg_quality": 95,  # Used with encode_workers
                     # "format": "XVID",  # leaks memory like crazy (on RasPi)
                     # "format": "mp4v",
-                    "output_data": "webcam0.avi",
-                    "output_metadata": "webcam0.csv",
+                    "output_data": "webcam{index}.avi",
+                    "output_metadata": "webcam{index}.csv",
                     "output_metadata_threshold": 300,
+                    "queue_size": 30,  # Frames are large; drop them instead of running out of memory
+                    "queue_policy": "drop_oldest",
+                    "buffer_pool_size": 40,  # Reused frame buffers; should exceed queue_size
+                    "bandwidth_mbps": 0,  # Frames beyond this many published Mbit/s are skipped (decoded: raw pixel bytes, "mjpeg": JPEG bytes); 0: unlimited
+                    # One entry per camera, each overriding the options above, e.g.
+                    # [{"device": 0}, {"device": 1, "rotation": 180, "bandwidth_mbps": 80}]
+                    # named webcam0, webcam1, ... Empty: a single instance "webcam".
+                    "instances": [],
                 },
                 "imu": {
                     "name": "imu",
                     "active": False,
                     "dry-run": False,
-                    "frequency": 5,
+                    "mode": "poll",  # "poll": read registers per sample, "fifo": drain the sensor's FIFO in batches
+                    "frequency": 5,  # Up to 1000Hz
+                    "fifo_read_interval": .25,  # Shortened automatically so the 1KB FIFO cannot overflow
                     "output": "imu.csv",
+                    "output_binary": "imu.bin",
+                    "output_format": "csv",  # "csv" or "binary" (see calchas.common.recfile)
                     "output_write_threshold": 200,
+                    "queue_size": 0,  # Unbounded: recorded samples are never dropped
+                    "queue_policy": "block",
                     "i2c_bus": 1,
                     "address": 0x69,
                     "power_mgmt_1": 0x6b,
+                    "dlpf_cfg": 1,  # Digital low-pass filter; 1-6 keep the gyro output rate at 1kHz
                 },
                 "gps": {
                     "name": "gps",
                     "active": False,
                     "dry-run": False,
                     "output": "gps.csv",
+                    "output_binary": "gps.bin",
+                    "output_format": "csv",  # "csv" or "binary" (see calchas.common.recfile)
                     "output_write_threshold": 100,
+                    "queue_size": 0,  # Unbounded: recorded samples are never dropped
+                    "queue_policy": "block",
                     "serial_dev": "/dev/ttyAMA0",
                     "serial_baudrate": 9600,
                     "serial_timeout": 1.,
+                    "protocol": "nmea",  # "nmea" or "ubx" (NAV-PVT with ground speed, fix quality and GPS time)
+                    "rate": "5Hz",  # "1Hz", "5Hz" or "10Hz"
+                    "output_sentences": ["GGA"],  # NMEA mode: add "RMC"/"VTG" for speed, "GSA" for DOP, "GSV" for satellites
                 },
             },
         }